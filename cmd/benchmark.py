@@ -67,7 +67,10 @@ def main(args):
     queries = {c[0]: crops for crops in crops_per_label.values()
                            for c in crops}
     
+    start_time = timer()
     search_model = SearchModel.from_config(config)
+    print('Loading the search model took {:.4f} seconds'.format(
+        timer() - start_time))
     
     for i in range(10):
         warmup_jit(search_model, sorted(queries), config['rerank_n'], map_n)
@@ -77,6 +80,9 @@ def main(args):
 
     print('Average time for {} queries: {:.4f} seconds'.format(len(queries), 
         total_time / len(queries)))
+    print('Feature cache: {hits} hits, {misses} misses, {evictions} '
+          'evictions, {entries} entries using {bytes} bytes'.format(
+            **search_model.feature_cache.stats))
 
 
 if __name__ == '__main__':
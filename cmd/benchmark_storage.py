@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Script comparing disk usage and loading time of feature map formats"""
+import os
+import sys
+import argparse
+import tempfile
+from os.path import join
+from timeit import default_timer as timer
+
+import numpy as np
+
+# Path hack to be able to import from sibling directory
+sys.path.append(os.path.abspath(os.path.split(os.path.realpath(__file__))[0]
+                                + '/..'))
+from src.features import (FEATURE_FORMATS, feature_file_path,
+                          save_features, load_features, FeatureMetadata)
+
+parser = argparse.ArgumentParser(description='Benchmark feature map formats')
+parser.add_argument('--features-dir', required=True,
+                    help='Folder where extracted data is stored')
+parser.add_argument('-n', dest='num_images', type=int, default=100,
+                    help='Number of feature maps to benchmark on')
+parser.add_argument('name', help='(Dataset) name of the extracted files')
+
+
+def benchmark_format(feature_maps, feature_format, out_dir):
+    """Writes feature maps in a format and measures size and loading time
+
+    Returns: (total size in bytes, average loading time in seconds)
+    """
+    total_size = 0
+    total_time = 0.0
+    for idx, features in enumerate(feature_maps):
+        path = feature_file_path(out_dir, str(idx), feature_format)
+        save_features(path, features)
+        total_size += os.path.getsize(path)
+
+        start_time = timer()
+        loaded = load_features(path)
+        total_time += timer() - start_time
+        assert np.array_equal(loaded, features)
+
+    return total_size, total_time / len(feature_maps)
+
+
+def main(args):
+    args = parser.parse_args(args)
+
+    meta_file_path = join(args.features_dir, '{}.meta'.format(args.name))
+    metadata = FeatureMetadata.load(meta_file_path)
+    feature_format = metadata.get('feature_format', 'dense')
+
+    feature_maps = []
+    num_zeros = 0
+    num_entries = 0
+    for idx in range(min(args.num_images, len(metadata))):
+        path = feature_file_path(args.features_dir, metadata.image(idx), 
+                                 feature_format)
+        features = load_features(path)
+        num_zeros += np.count_nonzero(features == 0)
+        num_entries += features.size
+        feature_maps.append(features)
+
+    print('Benchmarking on {} feature maps with {:.2%} zero '
+          'activations'.format(len(feature_maps), num_zeros / num_entries))
+
+    # Note that loading times are measured with a warm page cache, and that
+    # the file size equals the amount of page cache a loaded map occupies.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.mkdir(join(tmp_dir, 'features'))
+        for fmt in sorted(FEATURE_FORMATS.keys()):
+            size, load_time = benchmark_format(feature_maps, fmt, tmp_dir)
+            print('{}: {:.2f} MB on disk, {:.2f} ms average loading '
+                  'time'.format(fmt, size / 2**20, load_time * 1000))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -14,13 +14,18 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 from src.data.notary_charters.annotations import (parse_labeled_annotations, 
                                                   write_labeled_annotations)
 from src.util import convert_image
-from src.search import SearchModel, search
+from src.search import SearchModel, AdaptiveDepth, search
+from src.search.depth import DEFAULT_MIN_N, DEFAULT_MARGIN, DEFAULT_GAP
 
 parser = argparse.ArgumentParser(description='Evaluate a model\'s performance')
 parser.add_argument('config', help='Search model config to use')
 parser.add_argument('query_dataset', help='Path to query dataset')
 parser.add_argument('predictions_file', 
                     help='File saving predictions to or containing predictions')
+parser.add_argument('--adaptive', action='store_true',
+                    help='Choose the number of results to localize and '
+                    'rerank from the first stage similarities, between '
+                    'map_n and rerank_n, instead of always using rerank_n')
 
 # Number of images a label must have to be considered as a query
 MIN_RELEVANT_ELEMENTS = 2
@@ -88,6 +93,10 @@ def main(args):
         config = json.load(f)
 
     map_n = config['map_n']
+    if args.adaptive and map_n > config['rerank_n']:
+        # The adaptive depth localizes at least map_n and at most rerank_n
+        print('rerank_n needs to be at least map_n when using --adaptive')
+        return
 
     crops_per_label = defaultdict(list)
     for name, bbox, label in parse_labeled_annotations(args.query_dataset):
@@ -117,10 +126,23 @@ def main(args):
                 break
             predictions[query] = preds[:map_n]
 
+    localize_n = config['rerank_n']
+    if args.adaptive:
+        # At least map_n results are needed for the evaluation
+        adaptive_depth = AdaptiveDepth(
+            min_n=max(config.get('localize_min_n', DEFAULT_MIN_N), map_n),
+            max_n=config['rerank_n'],
+            margin=config.get('localize_margin', DEFAULT_MARGIN),
+            gap=config.get('localize_gap', DEFAULT_GAP))
+        localize_n = adaptive_depth
+
+    depth_stats = None
     if predictions is None:
         search_model = SearchModel.from_config(config)
         predictions = run_predictions(search_model, sorted(queries), 
-                                      config['rerank_n'], map_n)
+                                      localize_n, map_n)
+        if args.adaptive:
+            depth_stats = adaptive_depth.stats
         with open(args.predictions_file, 'w') as f:
             json.dump(predictions, f)
 
@@ -166,5 +188,16 @@ def main(args):
     print('\tIoU over {}/{} correctly retrieved '
           'images: {:.4f}'.format(correct_items, total_items, avg_iou))
 
+    if depth_stats is not None:
+        saved = 1 - depth_stats['localized'] / depth_stats['candidates']
+        print('Adaptive localization depth:')
+        print('\tLocalized {}/{} results ({:.1%} saved), {:.1f} per '
+              'query'.format(depth_stats['localized'], 
+                             depth_stats['candidates'], saved,
+                             depth_stats['localized'] / depth_stats['queries']))
+    elif args.adaptive:
+        print('Localization depth is only reported when running the queries, '
+              'not for existing predictions')
+
 if __name__ == '__main__':
     main(sys.argv[1:])
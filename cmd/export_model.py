@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""Script exporting truncated pretrained models to a local model cache"""
+import os
+import sys
+import argparse
+
+# Path hack to be able to import from sibling directory
+sys.path.append(os.path.abspath(os.path.split(os.path.realpath(__file__))[0]
+                                + '/..'))
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+from src.models import export_model
+
+parser = argparse.ArgumentParser(description=
+                                 'Export a model to the model cache')
+parser.add_argument('--models-dir', default='models/cache',
+                    help='Folder of the model cache')
+parser.add_argument('--output-layer', default=None,
+                    help='Layer at which the model gets truncated')
+parser.add_argument('model', help='Name of model to export')
+
+
+def main(args):
+    args = parser.parse_args(args)
+
+    if not os.path.isdir(args.models_dir):
+        os.makedirs(args.models_dir)
+
+    path = export_model(args.model, args.models_dir, args.output_layer)
+    print('Exported model {} to {}'.format(args.model, path))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,13 +1,12 @@
 #!/usr/bin/env python3
 import argparse
-import json
+import multiprocessing
 import os
 import sys
 from os.path import join, exists
 
 import numpy as np
-from sklearn.decomposition import PCA
-from sklearn.externals import joblib
+from sklearn.decomposition import PCA, IncrementalPCA
 
 # Path hack to be able to import from sibling directory
 sys.path.append(os.path.abspath(os.path.split(os.path.realpath(__file__))[0]
@@ -17,7 +16,14 @@ from src.util import load_image
 from src.models import load_model
 from src.features import compute_features, \
                          compute_r_macs, \
-                         compute_representation
+                         compute_representation, \
+                         feature_file_path, \
+                         save_features, \
+                         load_features, \
+                         FEATURE_FORMATS, \
+                         PCAWhitening, \
+                         load_whitening, \
+                         FeatureMetadata
 
 parser = argparse.ArgumentParser(description=
                                  'Extract feature representations')
@@ -31,15 +37,42 @@ parser.add_argument('--image-dir',
                     default='../data/working')
 parser.add_argument('--model', default='VGG16',
                     help='Name of model or path to model definition')
+parser.add_argument('--model-cache', default='', 
+                    help='Folder of the model cache')
+parser.add_argument('--feature-format', default='dense', 
+                    choices=sorted(FEATURE_FORMATS.keys()),
+                    help='Storage format of the extracted feature maps')
+parser.add_argument('--feature-dtype', default='float32', 
+                    choices=['float32', 'float16'],
+                    help='Data type the extracted feature maps are stored in')
+parser.add_argument('--fused', action='store_true',
+                    help='Compute representations while extracting features, '
+                    'using a previously learned PCA')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Number of processes to use')
+parser.add_argument('--pca-batch-size', type=int, default=10000,
+                    help='Number of rmacs per incremental PCA update')
+parser.add_argument('--pca-samples', type=int, default=None,
+                    help='Learn PCA on a uniform sample of this many rmacs '
+                    'instead of incrementally on all of them')
 parser.add_argument('command', choices=['features', 'pca', 'repr'],
                     help='Action to execute')
 parser.add_argument('name', 
                     help='(Dataset) name to use for extracted files')
 
 
-def extract_conv_features(name, model_name, features_dir, image_dir, root_dir):
+def extract_conv_features(name, model_name, features_dir, image_dir, root_dir,
+                          feature_format='dense', feature_dtype='float32',
+                          pca=None, model_cache=''):
     """Extracts features of all images in image_dir and 
     saves them for later use.
+
+    Storing the features as float16 halves their size, with the features 
+    being upcasted again where the computations need higher precision.
+
+    If a PCA is passed, the image representations are computed in the same 
+    pass while the features are still in memory, and saved as well. This 
+    avoids reading all features again in a separate repr step.
     """
     image_dir = os.path.abspath(image_dir)
 
@@ -53,9 +86,16 @@ def extract_conv_features(name, model_name, features_dir, image_dir, root_dir):
               if os.path.splitext(img)[1].lower() in extensions]
     images = sorted(images)
 
-    model = load_model(model_name)
+    model = load_model(model_name, model_cache)
 
-    meta_data = {'model': model_name}
+    attributes = {'model': model_name, 'feature_format': feature_format}
+    entries = []
+
+    if pca is not None:
+        repr_file_path = join(features_dir, '{}.repr.npy'.format(name))
+        repr_store = np.lib.format.open_memmap(
+            repr_file_path, mode='w+', dtype=np.float64,
+            shape=(len(images), pca.output_size))
 
     for idx, image_name in enumerate(images):
         print('{}/{}: extracting features of image {}'.format(idx+1, 
@@ -64,76 +104,215 @@ def extract_conv_features(name, model_name, features_dir, image_dir, root_dir):
         image_path = join(image_dir, image_name)
         image = load_image(image_path)
         
-        features = compute_features(model, image)
+        features = compute_features(model, image).astype(feature_dtype)
 
-        np.save(join(out_dir, os.path.basename(image_name)), features)
-        meta_data[idx] = {
+        save_features(feature_file_path(features_dir, image_name, 
+                                        feature_format), features)
+        entries.append({
             'image': os.path.relpath(image_path, root_dir),
             'height': image.shape[0],
-            'width': image.shape[1]
-        }
+            'width': image.shape[1],
+            'feature_height': features.shape[0],
+            'feature_width': features.shape[1]
+        })
+
+        if pca is not None:
+            representation = compute_representation(features, pca)
+            repr_store[idx] = np.squeeze(representation, axis=0)
+
+    if pca is not None:
+        repr_store.flush()
+        print('Computed {} image representations and '
+              'saved them to {}'.format(len(images), repr_file_path))
+
+    metadata = FeatureMetadata.from_entries(attributes, entries)
+    metadata.save(join(features_dir, '{}.meta'.format(name)))
+
+
+def _feature_file_paths(metadata, features_dir):
+    """Returns the paths to the feature files of all images, ordered by index"""
+    feature_format = metadata.get('feature_format', 'dense')
+    return [feature_file_path(features_dir, metadata.image(idx), 
+                              feature_format)
+            for idx in range(len(metadata))]
 
-    meta_file_name = '{}.meta'.format(name)
-    with open(join(features_dir, meta_file_name), 'w') as f:
-        json.dump(meta_data, f)
 
+def _load_r_macs(features_file):
+    return compute_r_macs(load_features(features_file))
 
-def learn_pca(metadata, name, features_dir):
+
+def _iter_r_macs(features_files, n_workers=1):
+    """Generates the rmacs of each feature file, computed in parallel by 
+    n_workers processes"""
+    if n_workers > 1:
+        with multiprocessing.Pool(n_workers) as pool:
+            yield from pool.imap(_load_r_macs, features_files, chunksize=4)
+    else:
+        yield from map(_load_r_macs, features_files)
+
+
+def _fit_incremental_pca(r_macs_iter, batch_size):
+    """Fits an IncrementalPCA on batches of rmacs
+
+    Rmacs are buffered until there are at least two batches, such that the 
+    last update, which gets all remaining rmacs, has enough samples as well.
+
+    Returns: (pca, number of rmacs)
+    """
+    pca = None
+    buffer = []
+    num_buffered = 0
+    num_r_macs = 0
+    for r_macs in r_macs_iter:
+        if pca is None:
+            pca = IncrementalPCA(n_components=r_macs.shape[1])
+            batch_size = max(batch_size, r_macs.shape[1])
+        buffer.append(r_macs)
+        num_buffered += len(r_macs)
+        num_r_macs += len(r_macs)
+
+        if num_buffered >= 2 * batch_size:
+            batch = np.vstack(buffer)
+            pca.partial_fit(batch[:batch_size])
+            buffer = [batch[batch_size:]]
+            num_buffered -= batch_size
+
+    assert pca is not None and num_r_macs >= pca.n_components, \
+        'Need at least as many rmacs as dimensions to compute PCA, ' \
+        'i.e. increase the number of input images'
+    pca.partial_fit(np.vstack(buffer))
+    return pca, num_r_macs
+
+
+def _sample_r_macs(r_macs_iter, num_samples, rng):
+    """Uniformly samples rmacs using reservoir sampling
+
+    Returns: (array of sampled rmacs, number of rmacs)
+    """
+    samples = None
+    num_r_macs = 0
+    for r_macs in r_macs_iter:
+        if samples is None:
+            samples = np.empty((num_samples, r_macs.shape[1]), r_macs.dtype)
+        for r_mac in r_macs:
+            if num_r_macs < num_samples:
+                samples[num_r_macs] = r_mac
+            else:
+                idx = rng.randint(0, num_r_macs + 1)
+                if idx < num_samples:
+                    samples[idx] = r_mac
+            num_r_macs += 1
+
+    assert samples is not None, \
+        'Need feature files to compute PCA, i.e. extract features of at ' \
+        'least one input image'
+    return samples[:num_r_macs], num_r_macs
+
+
+def learn_pca(metadata, name, features_dir, batch_size=10000, 
+              num_samples=None, n_workers=1):
     """Computes regional mac features and learns PCA on them to be able 
     to whiten them later.
 
-    This method assumes that there is enough memory available to hold all 
-    r_macs and do the PCA computation. If this assumption does not hold, 
-    we can switch to a memmapped numpy array and IncrementalPCA.
+    The rmacs are streamed from the feature files, such that memory usage 
+    is bounded independent of the number of images. By default, an 
+    IncrementalPCA is fitted on batches of batch_size rmacs. If num_samples 
+    is given, a uniform sample of num_samples rmacs is taken instead and a 
+    PCA is fitted on that sample.
     """
-    num_features = sum([1 for m in metadata.keys() if m.isdigit()])
-    r_macs = []
-    for idx in range(num_features):
-        data = metadata[str(idx)]
-        features_file = join(features_dir, 'features/', 
-                             os.path.basename(data['image']))
-        features = np.load('{}.npy'.format(features_file))
-        r_macs += compute_r_macs(features)
-
-    r_macs = np.vstack(r_macs)
-
-    assert len(r_macs.shape) == 2
-    assert r_macs.shape[0] >= r_macs.shape[1], \
-        'Need at least {} rmacs to compute PCA, ' \
-        'i.e. increase the number of input images'.format(r_macs.shape[1])
-
-    print('Extracted {} rmacs on {} images'.format(r_macs.shape[0], 
-                                                   len(metadata)))
-    
-    pca = PCA(n_components=r_macs.shape[1])
-    pca.fit(r_macs)
+    features_files = _feature_file_paths(metadata, features_dir)
+    r_macs_iter = _iter_r_macs(features_files, n_workers)
+
+    if num_samples is None:
+        pca, num_r_macs = _fit_incremental_pca(r_macs_iter, batch_size)
+    else:
+        rng = np.random.RandomState(1337)
+        r_macs, num_r_macs = _sample_r_macs(r_macs_iter, num_samples, rng)
+        assert r_macs.shape[0] >= r_macs.shape[1], \
+            'Need at least {} rmacs to compute PCA, ' \
+            'i.e. increase the number of input images ' \
+            'or samples'.format(r_macs.shape[1])
+        pca = PCA(n_components=r_macs.shape[1])
+        pca.fit(r_macs)
+
+    print('Extracted {} rmacs on {} images'.format(num_r_macs, 
+                                                   len(features_files)))
 
     pca_path = join(features_dir, '{}.pca'.format(name))
-    joblib.dump(pca, pca_path)
-    print('Computed PCA and saved it to {}'.format(pca_path))
+    PCAWhitening.from_pca(pca).save(pca_path)
+    print('Computed PCA and saved it to {}_*.npy'.format(pca_path))
+
+
+# PCA used by the worker processes computing representations
+_repr_pca = None
+
+def _init_repr_worker(pca):
+    global _repr_pca
+    _repr_pca = pca
+
+
+def _compute_repr_chunk(args):
+    """Computes representations of a chunk of images and writes them 
+    directly to their rows in the memory mapped representation file"""
+    repr_file_path, chunk = args
+    repr_store = np.lib.format.open_memmap(repr_file_path, mode='r+')
+    for idx, features_file in chunk:
+        features = load_features(features_file)
+        representation = compute_representation(features, _repr_pca)
+        repr_store[idx] = np.squeeze(representation, axis=0)
+    repr_store.flush()
+    return len(chunk)
+
+
+def _iter_repr_chunks(chunks, pca, n_workers=1):
+    """Generates the number of representations computed for each chunk, 
+    which are computed in parallel by n_workers processes"""
+    if n_workers > 1:
+        with multiprocessing.Pool(n_workers, initializer=_init_repr_worker, 
+                                  initargs=(pca,)) as pool:
+            yield from pool.imap_unordered(_compute_repr_chunk, chunks)
+    else:
+        _init_repr_worker(pca)
+        yield from map(_compute_repr_chunk, chunks)
 
 
-def compute_global_representation(metadata, name, features_dir, pca=None):
+def compute_global_representation(metadata, name, features_dir, pca=None,
+                                  n_workers=1, chunk_size=32):
     """Uses previously extracted features to compute an image representation 
     which is suitable for image retrieval.
+
+    The images are distributed in chunks of chunk_size to n_workers 
+    processes, which write the representations into a preallocated, memory 
+    mapped representation file.
     """
-    repr_store = None
-    for idx, data in metadata.items():
-        if not idx.isdigit():
-            continue
-        features_file = join(features_dir, 'features/', 
-                             os.path.basename(data['image']))
-        features = np.load('{}.npy'.format(features_file))
-
-        representation = compute_representation(features, pca)
-        if repr_store is None:
-            repr_store = np.empty((len(metadata), representation.shape[-1]))
-        repr_store[int(idx)] = np.squeeze(representation, axis=0)
+    features_files = _feature_file_paths(metadata, features_dir)
+    num_images = len(features_files)
+    assert num_images > 0, 'Need feature files to compute representations, ' \
+        'i.e. extract features of at least one input image'
+
+    if pca is not None:
+        repr_size = pca.output_size
+    else:
+        repr_size = load_features(features_files[0]).shape[-1]
 
     repr_file_path = join(features_dir, '{}.repr.npy'.format(name))
-    np.save(repr_file_path, repr_store)
+    repr_store = np.lib.format.open_memmap(repr_file_path, mode='w+', 
+                                           dtype=np.float64,
+                                           shape=(num_images, repr_size))
+    del repr_store  # Flushes the file header
+
+    indexed_files = list(enumerate(features_files))
+    chunks = [(repr_file_path, indexed_files[i:i + chunk_size])
+              for i in range(0, num_images, chunk_size)]
+
+    num_done = 0
+    for num_computed in _iter_repr_chunks(chunks, pca, n_workers):
+        num_done += num_computed
+        print('{}/{}: computed image representations'.format(num_done, 
+                                                             num_images))
+
     print('Computed {} image representations and '
-          'saved them to {}'.format(len(metadata), repr_file_path))
+          'saved them to {}'.format(num_images, repr_file_path))
 
 
 def main(args):
@@ -145,9 +324,21 @@ def main(args):
     if not exists(args.features_dir):
         os.mkdir(args.features_dir)
 
+    pca_path = join(args.features_dir, '{}.pca'.format(args.name))
+
     if args.command == 'features':
+        pca = None
+        if args.fused:
+            pca = load_whitening(pca_path)
+            if pca is None:
+                print('Must learn PCA first to compute representations '
+                      'while extracting features')
+                return
+
         extract_conv_features(args.name, args.model, args.features_dir, 
-                              args.image_dir, args.root_dir)
+                              args.image_dir, args.root_dir, 
+                              args.feature_format, args.feature_dtype, pca,
+                              args.model_cache)
         return
 
 
@@ -156,19 +347,15 @@ def main(args):
         print('Must extract features of images first')
         return
 
-    with open(meta_file_path, 'r') as f:
-        metadata = json.load(f)
+    metadata = FeatureMetadata.load(meta_file_path)
 
     if args.command == 'pca':
-        learn_pca(metadata, args.name, args.features_dir)
+        learn_pca(metadata, args.name, args.features_dir, 
+                  args.pca_batch_size, args.pca_samples, args.workers)
     elif args.command == 'repr':
-        pca_path = join(args.features_dir, '{}.pca'.format(args.name))
-        if exists(pca_path):
-            pca = joblib.load(pca_path)
-        else:
-            pca = None
+        pca = load_whitening(pca_path)
         compute_global_representation(metadata, args.name, 
-                                      args.features_dir, pca)
+                                      args.features_dir, pca, args.workers)
     
 
 if __name__ == '__main__':
@@ -13,6 +13,7 @@ sys.path.append(os.path.abspath(os.path.split(os.path.realpath(__file__))[0]
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 from src.util import convert_image, crop_image
 from src.search import SearchModel, search
+from src.search.warmup import QueryLog, warmup
 
 parser = argparse.ArgumentParser(description=
                                  'Query a database for similar images')
@@ -22,6 +23,8 @@ parser.add_argument('--features', required=True,
                     help='Path to features to use')
 parser.add_argument('--model', required=True, 
                     help='Name or path of model to use')
+parser.add_argument('--model-cache', default='', 
+                    help='Folder of the model cache')
 parser.add_argument('--output', 
                     help='Folder to output the found images '
                     'with bounding box annotations')
@@ -32,6 +35,12 @@ parser.add_argument('-n', dest='top_n', type=int, default=5,
 parser.add_argument('--bbox', type=int, nargs=4, default=None,
                     metavar=('left', 'upper', 'right', 'lower'),
                     help='Specify a bounding box on the query')
+parser.add_argument('--query-log', 
+                    help='File to record the results of the queries to')
+parser.add_argument('--warmup', action='store_true',
+                    help='Warm up the search model before querying, '
+                    'preloading the images most often found by the queries '
+                    'in the query log')
 parser.add_argument('images', nargs='+', 
                     help='One or more images to query for')
 
@@ -61,7 +70,19 @@ def main(args):
         else:
             print('Image {} does not exist. Skipping.'.format(image_path))
 
-    search_model = SearchModel(args.model, args.features, args.database)
+    search_model = SearchModel(args.model, args.features, args.database,
+                               args.model_cache)
+
+    if args.warmup:
+        start_time = timer()
+        log_path = args.query_log
+        if log_path and not os.path.exists(log_path):
+            log_path = None
+        num_preloaded = warmup(search_model, log_path)
+        print('Warming up took {:.6f} seconds, preloaded {} feature '
+              'maps'.format(timer() - start_time, num_preloaded))
+
+    query_log = QueryLog(args.query_log) if args.query_log else None
 
     for image_path in query_images:
         with Image.open(image_path) as image:
@@ -75,6 +96,9 @@ def main(args):
                                                top_n=args.top_n)
         end_time = timer()
 
+        if query_log:
+            query_log.record(results)
+
         print('Search took {:.6f} seconds'.format(end_time-start_time))
         print('Top {} results for query image {}'.format(args.top_n, 
                                                          image_path))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Search server shared by the processes of the web backend"""
+import os
+import sys
+import json
+import argparse
+from timeit import default_timer as timer
+
+# Path hack to be able to import from sibling directory
+sys.path.append(os.path.abspath(os.path.split(os.path.realpath(__file__))[0]
+                                + '/..'))
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+from src.search import SearchModel
+from src.search.server import SearchServer
+from src.search.warmup import warmup
+
+parser = argparse.ArgumentParser(description='Serve searches on a Unix '
+                                 'socket to several processes')
+parser.add_argument('--config', required=True,
+                    help='Configuration file of the search model')
+parser.add_argument('--socket', 
+                    help='Path of the Unix socket to listen on. Defaults to '
+                    'server_socket of the config')
+parser.add_argument('--warmup', action='store_true',
+                    help='Warm up the search model before serving')
+parser.add_argument('--query-log', 
+                    help='Query log to preload the most often found images '
+                    'from when warming up')
+
+
+def main(args):
+    args = parser.parse_args(args)
+
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+
+    address = args.socket or config.get('server_socket')
+    if not address:
+        print('No socket given in arguments or config')
+        return
+
+    start_time = timer()
+    search_model = SearchModel.from_config(config)
+    print('Loading the search model took {:.2f} seconds'.format(
+        timer() - start_time))
+
+    if args.warmup:
+        start_time = timer()
+        num_preloaded = warmup(search_model, args.query_log)
+        print('Warming up took {:.2f} seconds, preloaded {} feature '
+              'maps'.format(timer() - start_time, num_preloaded))
+
+    print('Serving on {}'.format(address))
+    SearchServer(search_model, address).serve_forever()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -10,9 +10,21 @@ proj_dir = os.path.abspath(os.path.split(os.path.realpath(__file__))[0]
 
 # Defines all unit test scripts
 TESTS = [
+    'src.tests.test_admission',
+    'src.tests.test_cache',
+    'src.tests.test_depth',
     'src.tests.test_extract',
+    'src.tests.test_fetch',
+    'src.tests.test_imports',
     'src.tests.test_localization',
-    'src.tests.test_util'
+    'src.tests.test_metadata',
+    'src.tests.test_prefork',
+    'src.tests.test_search',
+    'src.tests.test_server',
+    'src.tests.test_session',
+    'src.tests.test_storage',
+    'src.tests.test_util',
+    'src.tests.test_warmup'
 ]
 
 def main(args):
@@ -0,0 +1,99 @@
+"""Admission control of concurrent requests"""
+import threading
+
+class OverloadedError(Exception):
+    """Raised if a request is not admitted, as too many requests are running
+    and waiting already"""
+    def __init__(self, message, retry_after):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Limits the number of requests running at once
+
+    Requests over the limit wait in a queue of bounded length for a running
+    request to finish. Requests arriving at a full queue, or waiting longer
+    than max_wait seconds, are rejected right away, such that the latency of
+    the admitted requests stays bounded under load. Requests arriving while
+    at least degrade_depth requests are queued are admitted in degraded
+    mode, in which they should do less work.
+    """
+    def __init__(self, max_running, max_queued=0, max_wait=10.0,
+                 degrade_depth=None, retry_after=1):
+        """
+        Args:
+        max_running: maximum number of requests running at once
+        max_queued: maximum number of requests waiting to run
+        max_wait: maximum time in seconds a request waits to run
+        degrade_depth: queue length from which on requests are admitted in
+            degraded mode. If None, requests are never degraded.
+        retry_after: time in seconds after which rejected requests should be
+            retried
+        """
+        assert max_running > 0
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.degrade_depth = degrade_depth
+        self.retry_after = retry_after
+        self._cond = threading.Condition()
+        self._running = 0
+        self._queued = 0
+        self._admitted = 0
+        self._degraded = 0
+        self._rejected = 0
+
+    def acquire(self):
+        """Waits until the request can run
+
+        Returns: True if the request is admitted in degraded mode
+
+        Raises: OverloadedError if the request is rejected
+        """
+        with self._cond:
+            degraded = False
+            if self._running >= self.max_running:
+                if self._queued >= self.max_queued:
+                    self._rejected += 1
+                    raise OverloadedError('Too many requests',
+                                          self.retry_after)
+
+                degraded = self.degrade_depth is not None \
+                    and self._queued >= self.degrade_depth
+                self._queued += 1
+                try:
+                    admitted = self._cond.wait_for(
+                        lambda: self._running < self.max_running,
+                        timeout=self.max_wait)
+                finally:
+                    self._queued -= 1
+                if not admitted:
+                    self._rejected += 1
+                    raise OverloadedError('Timed out waiting to run',
+                                          self.retry_after)
+
+            self._running += 1
+            self._admitted += 1
+            if degraded:
+                self._degraded += 1
+            return degraded
+
+    def release(self):
+        """Marks an admitted request as finished"""
+        with self._cond:
+            self._running -= 1
+            self._cond.notify()
+
+    @property
+    def stats(self):
+        """Returns a dict with the number of running and queued requests,
+        and the number of admitted, degraded and rejected requests"""
+        with self._cond:
+            return {
+                'running': self._running,
+                'queued': self._queued,
+                'admitted': self._admitted,
+                'degraded': self._degraded,
+                'rejected': self._rejected
+            }
@@ -2,3 +2,8 @@ from src.features.extract import (compute_features, compute_representation,
                                   compute_localization_representation, 
                                   compute_r_macs, representation_size, 
                                   normalize)
+from src.features.storage import (FEATURE_FORMATS, feature_file_path, 
+                                  save_features, load_features, 
+                                  load_feature_shape)
+from src.features.whitening import PCAWhitening, load_whitening
+from src.features.metadata import FeatureMetadata
@@ -2,39 +2,53 @@ from math import floor
 
 import numpy as np
 
-from src.util import normalize
+from src.util import normalize, normalize_rows
 
-def _region_generator(array, size, overlap, verbose=False):
-    """A generator which returns square overlapping regions"""
-    height, width = array.shape[0], array.shape[1]
-    row = 0
-    while row < height:
-        row_end = min(row + size, height)
+def _region_starts(length, size, overlap):
+    """Computes the start offsets of square overlapping regions along one axis
 
-        col = 0
-        while col < width:
-            col_end = min(col + size, width)
-            if verbose:
-                print('Current region: row {}:{}, col {}:{}'.format(
-                    row, row_end, col, col_end))
+    Regions are sampled independently along both axes, such that the regions 
+    of a feature map are all combinations of row and column offsets. 
+    Regions running over the border are clipped to it.
+    """
+    starts = []
+    start = 0
+    while start < length:
+        starts.append(start)
+        if start + size == length:
+            break
+        start = round(start + (1 - overlap) * (start + size))
+    return starts
 
-            yield array[row:row_end, col:col_end]
 
-            if col + size == width:
-                break
-            col = round(col + (1 - overlap) * (col + size))
+def _window_max(array, starts, size, axis):
+    """Computes the maxima over windows along an axis
 
-        if row + size == height:
-            break
-        row = round(row + (1 - overlap) * (row + size))
+    Args:
+    array: array to compute the maxima on
+    starts: start offsets of the windows along the axis
+    size: length of the windows, which get clipped to the array border
+
+    Returns: array of the maxima, with len(starts) entries along the axis
+    """
+    index = [slice(None)] * array.ndim
+    maxima = []
+    for start in starts:
+        index[axis] = slice(start, start + size)
+        maxima.append(np.amax(array[tuple(index)], axis=axis))
+    return np.stack(maxima, axis=axis)
 
 
 def _compute_mac(features):
     """
     Computes maximum activations of convolutions, which is the 
     maximum across the spatial dimensions of the features.
+
+    The maximum is exact in any precision, but half precision features 
+    are upcasted afterwards to keep the following normalizations accurate.
     """
-    return np.amax(features, axis=(0,1))
+    mac = np.amax(features, axis=(0,1))
+    return mac.astype(np.promote_types(mac.dtype, np.float32), copy=False)
 
 
 def compute_r_macs(features, scales=(1, 4), verbose=False):
@@ -48,8 +62,8 @@ def compute_r_macs(features, scales=(1, 4), verbose=False):
         Higher scales result in smaller regions following the formula 
         given in the paper on p.4
 
-    Returns: list of r_mac vectors of shape (1, N), where N is the 
-    depth of the convolutional feature maps
+    Returns: array of r_mac vectors of shape (R, N), where R is the number 
+    of regions and N is the depth of the convolutional feature maps
     """
     assert len(features.shape) == 3
     height, width = features.shape[0], features.shape[1]
@@ -60,15 +74,25 @@ def compute_r_macs(features, scales=(1, 4), verbose=False):
         if verbose:
             print('Region width at scale {}: {}'.format(scale, r_size))
 
-        # Uniform sampling of square regions with 40% overlap
-        for region in _region_generator(features, r_size, 0.4):
-            r_mac = _compute_mac(region)
-            r_mac = normalize(np.expand_dims(r_mac, axis=0))
-            r_macs.append(r_mac)
+        # Uniform sampling of square regions with 40% overlap. 
+        # The maxima of all regions are computed separably, first over the 
+        # rows and then over the columns of the regions.
+        rows = _region_starts(height, r_size, 0.4)
+        cols = _region_starts(width, r_size, 0.4)
+        if verbose:
+            print('Region offsets at scale {}: rows {}, cols {}'.format(
+                scale, rows, cols))
+        row_macs = _window_max(features, rows, r_size, axis=0)
+        macs = _window_max(row_macs, cols, r_size, axis=1)
+        r_macs.append(macs.reshape(-1, features.shape[2]))
 
         if r_size == 1:
             break
-    return r_macs
+
+    r_macs = np.concatenate(r_macs)
+    r_macs = r_macs.astype(np.promote_types(r_macs.dtype, np.float32), 
+                           copy=False)
+    return normalize_rows(r_macs)
 
 
 def _compute_global_r_mac(features, pca=None):
@@ -76,23 +100,20 @@ def _compute_global_r_mac(features, pca=None):
     Computes global aggregation of rmacs from convolutional features
 
     Args:
-    pca (optional): sklearn.decomposition.PCA object which is applied to each 
-    mac to whiten the features
+    pca (optional): PCAWhitening object which is applied to each mac to 
+    whiten the features
     
     Returns: global image descriptor of shape (1, N), where N is the 
     depth of the convolutional feature maps
     """
     assert len(features.shape) == 3
     
-    global_r_mac = np.zeros((1, features.shape[2]))  # Sum of all regional features
     macs = compute_r_macs(features)
-    
-    for mac in macs:
-        if pca:
-            mac = pca.transform(mac)
-            mac = normalize(mac)
-        global_r_mac += mac
+    if pca is not None:
+        macs = normalize_rows(pca.transform(macs))
 
+    # Sum of all regional features
+    global_r_mac = np.sum(macs, axis=0, keepdims=True, dtype=np.float64)
     return normalize(global_r_mac)
 
 
@@ -116,8 +137,7 @@ def compute_representation(features, pca=None):
     suitable to retrieval
 
     Args:
-    pca (optional): sklearn.decomposition.PCA object which is used to whiten 
-    the features
+    pca (optional): PCAWhitening object which is used to whiten the features
     """
     global_r_mac = _compute_global_r_mac(features, pca)
     return global_r_mac
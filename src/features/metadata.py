@@ -0,0 +1,124 @@
+"""Metadata of the images of an extracted dataset"""
+import json
+import os
+from os.path import join, isdir, isfile
+
+import numpy as np
+
+class FeatureMetadata:
+    """Column store of the metadata of the images of an extracted dataset
+
+    Each per image property is stored as an integer column in its own .npy
+    file, and the image paths are stored as one UTF-8 encoded string table
+    with offsets into it. All arrays are loaded memory mapped, such that
+    loading takes constant time independent of the number of images, and
+    properties of many images can be looked up at once by indexing the
+    columns with an index array. Dataset wide attributes (e.g. the model)
+    are stored in a small JSON file.
+
+    Members:
+        attributes: dict of the dataset wide attributes
+        columns: dict mapping property names to arrays of shape (N,)
+    """
+    ATTRIBUTES_FILE = 'attributes.json'
+    IMAGE_TABLE_FILE = 'images.npy'
+    IMAGE_OFFSETS_FILE = 'image_offsets.npy'
+
+    def __init__(self, attributes, image_table, image_offsets, columns):
+        self.attributes = attributes
+        self.image_table = image_table
+        self.image_offsets = image_offsets
+        self.columns = columns
+
+    @staticmethod
+    def from_entries(attributes, entries):
+        """Constructs the metadata from a list of per image dicts
+
+        Args:
+        attributes: dict of the dataset wide attributes
+        entries: list of dicts, where the i-th dict contains the key 'image'
+            with the path of the i-th image, and integer valued properties
+        """
+        images = [entry['image'].encode('utf-8') for entry in entries]
+        image_offsets = np.zeros(len(images) + 1, dtype=np.int64)
+        image_offsets[1:] = np.cumsum([len(image) for image in images])
+        image_table = np.frombuffer(b''.join(images), dtype=np.uint8)
+
+        names = set(key for entry in entries for key in entry) - {'image'}
+        columns = {name: np.array([entry[name] for entry in entries],
+                                  dtype=np.int64)
+                   for name in names}
+        return FeatureMetadata(attributes, image_table, image_offsets,
+                               columns)
+
+    @staticmethod
+    def from_dict(metadata):
+        """Constructs the metadata from the JSON dict used by older versions,
+        which maps stringified indices to per image dicts"""
+        attributes = {k: v for k, v in metadata.items() if not k.isdigit()}
+        num_images = len(metadata) - len(attributes)
+        entries = [metadata[str(idx)] for idx in range(num_images)]
+        return FeatureMetadata.from_entries(attributes, entries)
+
+    @staticmethod
+    def load(path, mmap_mode='r'):
+        """Loads the metadata from a folder, or from a JSON file as written
+        by older versions"""
+        if isfile(path):
+            with open(path, 'r') as f:
+                return FeatureMetadata.from_dict(json.load(f))
+
+        with open(join(path, FeatureMetadata.ATTRIBUTES_FILE), 'r') as f:
+            attributes = json.load(f)
+        image_table = np.load(join(path, FeatureMetadata.IMAGE_TABLE_FILE),
+                              mmap_mode=mmap_mode)
+        image_offsets = np.load(join(path,
+                                     FeatureMetadata.IMAGE_OFFSETS_FILE),
+                                mmap_mode=mmap_mode)
+        columns = {}
+        for name in attributes.pop('columns'):
+            columns[name] = np.load(join(path, '{}.npy'.format(name)),
+                                    mmap_mode=mmap_mode)
+        return FeatureMetadata(attributes, image_table, image_offsets,
+                               columns)
+
+    def save(self, path):
+        if isfile(path):  # Replace metadata of older versions
+            os.remove(path)
+        if not isdir(path):
+            os.mkdir(path)
+
+        attributes = dict(self.attributes)
+        attributes['columns'] = sorted(self.columns.keys())
+        with open(join(path, FeatureMetadata.ATTRIBUTES_FILE), 'w') as f:
+            json.dump(attributes, f)
+        np.save(join(path, FeatureMetadata.IMAGE_TABLE_FILE), self.image_table)
+        np.save(join(path, FeatureMetadata.IMAGE_OFFSETS_FILE),
+                self.image_offsets)
+        for name, column in self.columns.items():
+            np.save(join(path, '{}.npy'.format(name)), column)
+
+    def __len__(self):
+        return len(self.image_offsets) - 1
+
+    def __getitem__(self, idx):
+        """Returns the metadata of one image as a dict"""
+        idx = int(idx)
+        metadata = {'image': self.image(idx)}
+        for name, column in self.columns.items():
+            metadata[name] = column[idx].item()
+        return metadata
+
+    def get(self, key, default=None):
+        """Returns a dataset wide attribute"""
+        return self.attributes.get(key, default)
+
+    def image(self, idx):
+        """Returns the path of an image"""
+        idx = int(idx)
+        start, end = self.image_offsets[idx], self.image_offsets[idx+1]
+        return self.image_table[start:end].tobytes().decode('utf-8')
+
+    def column(self, name):
+        """Returns the array of a per image property"""
+        return self.columns[name]
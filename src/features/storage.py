@@ -0,0 +1,85 @@
+"""Reading and writing of convolutional feature maps"""
+from os.path import basename, join, splitext
+
+import numpy as np
+
+# File extensions of the supported feature map formats.
+# 'dense' stores the raw array, 'sparse' stores a bit-packed mask of the
+# nonzero entries together with the nonzero values, which pays off for the
+# post-ReLU feature maps where most activations are zero.
+FEATURE_FORMATS = {
+    'dense': '.npy',
+    'sparse': '.npz'
+}
+
+
+def feature_file_path(features_dir, image_path, feature_format='dense'):
+    """Returns the path of the feature map file belonging to an image
+
+    Args:
+    features_dir: folder containing the extracted data of a dataset
+    image_path: path of the image the features were extracted from
+    feature_format: one of the keys of FEATURE_FORMATS
+    """
+    if feature_format not in FEATURE_FORMATS:
+        raise ValueError('Unknown feature format {}'.format(feature_format))
+    file_name = '{}{}'.format(basename(image_path),
+                              FEATURE_FORMATS[feature_format])
+    return join(features_dir, 'features/', file_name)
+
+
+def _save_sparse(file_path, features):
+    mask = features != 0
+    with open(file_path, 'wb') as f:
+        np.savez(f,
+                 shape=np.array(features.shape),
+                 mask=np.packbits(mask.ravel()),
+                 values=features[mask])
+
+
+def _load_sparse(file_path):
+    with np.load(file_path) as data:
+        shape = tuple(data['shape'])
+        values = data['values']
+        mask = np.unpackbits(data['mask'])[:int(np.prod(shape))]
+        features = np.zeros(shape, dtype=values.dtype)
+        features[mask.reshape(shape).astype(bool)] = values
+    return features
+
+
+def save_features(file_path, features):
+    """Saves a feature map in the format specified by the file extension"""
+    ext = splitext(file_path)[1]
+    if ext == FEATURE_FORMATS['dense']:
+        with open(file_path, 'wb') as f:
+            np.save(f, features)
+    elif ext == FEATURE_FORMATS['sparse']:
+        _save_sparse(file_path, features)
+    else:
+        raise ValueError('Unknown feature file extension {}'.format(ext))
+
+
+def load_features(file_path):
+    """Loads a feature map in the format specified by the file extension
+
+    Returns: dense feature map of shape (height, width, depth)
+    """
+    ext = splitext(file_path)[1]
+    if ext == FEATURE_FORMATS['dense']:
+        return np.load(file_path)
+    elif ext == FEATURE_FORMATS['sparse']:
+        return _load_sparse(file_path)
+    else:
+        raise ValueError('Unknown feature file extension {}'.format(ext))
+
+
+def load_feature_shape(file_path):
+    """Reads the shape of a stored feature map without loading the map"""
+    ext = splitext(file_path)[1]
+    if ext == FEATURE_FORMATS['dense']:
+        return np.load(file_path, mmap_mode='r').shape
+    elif ext == FEATURE_FORMATS['sparse']:
+        with np.load(file_path) as data:
+            return tuple(data['shape'])
+    else:
+        raise ValueError('Unknown feature file extension {}'.format(ext))
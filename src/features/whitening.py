@@ -0,0 +1,70 @@
+"""PCA whitening of representations, stored as plain arrays"""
+from os.path import isfile
+
+import numpy as np
+
+class PCAWhitening:
+    """Projects representations with a learned PCA
+
+    The PCA is stored as its mean vector and projection matrix in plain .npy
+    files, which can be loaded memory mapped and applied without sklearn.
+    """
+    def __init__(self, mean, projection):
+        self.mean = mean
+        self.projection = projection
+        # (x - mean) * P is computed as x * P - mean * P, such that the
+        # transformation needs a single matrix multiplication over x
+        self.bias = np.dot(mean, projection)
+
+    @staticmethod
+    def from_pca(pca):
+        """Constructs the whitening from a fitted sklearn PCA object"""
+        projection = pca.components_.T
+        if pca.whiten:
+            projection = projection / np.sqrt(pca.explained_variance_)
+        return PCAWhitening(pca.mean_, projection)
+
+    @staticmethod
+    def _file_paths(path):
+        return '{}_mean.npy'.format(path), '{}_projection.npy'.format(path)
+
+    @staticmethod
+    def exists(path):
+        return all(isfile(p) for p in PCAWhitening._file_paths(path))
+
+    @staticmethod
+    def load(path, mmap_mode='r'):
+        mean_path, projection_path = PCAWhitening._file_paths(path)
+        return PCAWhitening(np.load(mean_path, mmap_mode=mmap_mode),
+                            np.load(projection_path, mmap_mode=mmap_mode))
+
+    def save(self, path):
+        mean_path, projection_path = PCAWhitening._file_paths(path)
+        np.save(mean_path, self.mean)
+        np.save(projection_path, self.projection)
+
+    @property
+    def output_size(self):
+        return self.projection.shape[1]
+
+    def transform(self, x):
+        """Projects the rows of x, equivalent to pca.transform(x)"""
+        res = np.dot(x, self.projection)
+        res -= self.bias
+        return res
+
+
+def load_whitening(path):
+    """Loads a PCA whitening
+
+    Falls back to a pickled sklearn PCA object at path, as saved by
+    previous versions.
+
+    Returns: PCAWhitening object, or None if no PCA exists at path
+    """
+    if PCAWhitening.exists(path):
+        return PCAWhitening.load(path)
+    elif isfile(path):
+        from sklearn.externals import joblib
+        return PCAWhitening.from_pca(joblib.load(path))
+    return None
@@ -0,0 +1,129 @@
+"""Fetching of images from external URLs"""
+import io
+import socket
+import threading
+import time
+
+class FetchCapacityError(Exception):
+    """Raised if the maximum number of concurrent fetches is reached"""
+    pass
+
+
+def _shut_down(response):
+    """Shuts down the connection of a streamed response, which makes reads
+    blocked on it return. Closes the response instead if its connection was
+    already released."""
+    connection = response.raw.connection
+    sock = getattr(connection, 'sock', None)
+    if sock is None:
+        response.close()
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class ImageFetcher:
+    """Downloads files over pooled HTTP connections
+
+    The number of concurrent downloads is limited globally, such that slow
+    remote hosts can only occupy a bounded number of serving threads.
+    Connections to the same host are kept open and reused between downloads.
+    """
+    def __init__(self, max_concurrent=16, max_size=16*1024*1024, timeout=5,
+                 max_time=25, chunk_size=64*1024, wait_time=0.5):
+        """
+        Args:
+        max_concurrent: maximum number of concurrent downloads
+        max_size: maximum size of a downloaded file in bytes
+        timeout: maximum time in seconds to wait for the connection to open
+            and for each read
+        max_time: maximum time in seconds a download may take
+        chunk_size: size of the chunks the response is read in
+        wait_time: maximum time in seconds to wait for a free download slot
+        """
+        # Imported here as only needed by the web backend
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_time = max_time
+        self.chunk_size = chunk_size
+        self.wait_time = wait_time
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._request_exception = requests.exceptions.RequestException
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_concurrent,
+                              pool_maxsize=max_concurrent)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch(self, url):
+        """Downloads a file from a URL into a BytesIO object
+
+        Returns: BytesIO object positioned at its start, or None if the
+            download failed or the file exceeds the size or time limits
+
+        Raises: FetchCapacityError if no download slot becomes free in time
+        """
+        if not self._slots.acquire(timeout=self.wait_time):
+            raise FetchCapacityError('Too many concurrent downloads')
+        try:
+            return self._fetch(url)
+        finally:
+            self._slots.release()
+
+    def _fetch(self, url):
+        start_time = time.time()
+        try:
+            r = self.session.get(url, stream=True, timeout=self.timeout)
+        except self._request_exception:
+            return None
+
+        # A read blocks until a whole chunk arrived, which a slow host can 
+        # delay far beyond max_time. The connection is therefore shut down 
+        # when max_time is over, aborting any read in progress.
+        expired = threading.Event()
+        def expire():
+            expired.set()
+            _shut_down(r)
+        remaining_time = max(start_time + self.max_time - time.time(), 0)
+        watchdog = threading.Timer(remaining_time, expire)
+        watchdog.daemon = True
+        watchdog.start()
+
+        try:
+            if not r.ok:
+                return None
+
+            content_length = r.headers.get('Content-Length')
+            if content_length and content_length.isdigit() \
+                and int(content_length) > self.max_size:
+                return None
+
+            file = io.BytesIO()
+            size = 0
+            try:
+                for chunk in r.iter_content(self.chunk_size):
+                    if expired.is_set():
+                        return None
+
+                    size += len(chunk)
+                    if size > self.max_size:
+                        return None
+
+                    file.write(chunk)
+            except (self._request_exception, OSError):
+                return None
+
+            if expired.is_set():  # Connection shut down while reading
+                return None
+        finally:
+            watchdog.cancel()
+            r.close()
+
+        file.seek(0)
+        return file
@@ -1 +1 @@
-from src.models.load import load_model
+from src.models.load import load_model, export_model
@@ -1,7 +1,44 @@
+from os.path import join, isfile
+
 from src.models.pretrained import pretrained_models, preprocessor
 from src.models.model import Model
 
+def _cached_model_path(models_path, model_name, output_layer=None):
+    if output_layer is None:
+        file_name = '{}.h5'.format(model_name)
+    else:
+        file_name = '{}_{}.h5'.format(model_name, output_layer)
+    return join(models_path, file_name)
+
+
+def export_model(model_name, models_path, output_layer=None):
+    """Saves a pretrained model truncated at its output layer to the model 
+    cache in models_path, from where load_model can directly load it
+
+    Returns: path of the saved model
+    """
+    model = load_model(model_name, output_layer=output_layer)
+    path = _cached_model_path(models_path, model_name, output_layer)
+    model.kmodel.save(path)
+    return path
+
+
 def load_model(model_name, models_path='', output_layer=None):
+    """Loads a model
+
+    Args:
+    model_name: name of the model
+    models_path (optional): folder of the model cache. If the model was 
+        exported there with export_model, it is loaded from there instead of 
+        constructing the full pretrained model.
+    output_layer (optional): layer at which the model gets truncated
+    """
+    if models_path:
+        path = _cached_model_path(models_path, model_name, output_layer)
+        if isfile(path):
+            from keras.models import load_model as load_keras_model
+            return Model(load_keras_model(path), preprocessor(model_name))
+
     pretrained_model_fn = pretrained_models(model_name)
     if pretrained_model_fn is not None:
         if output_layer is not None:
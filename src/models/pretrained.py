@@ -1,6 +1,5 @@
-from keras.models import Model
-
 def _wrap_model(model, output_layer):
+    from keras.models import Model
     return Model(input=model.input, 
                  output=model.get_layer(output_layer).output)
 
@@ -0,0 +1,107 @@
+"""Preforking WSGI server
+
+The parent process opens the listening socket and forks the worker
+processes, which all accept connections on that socket. Data loaded in the
+parent before forking is shared copy-on-write by all workers, which keeps
+the memory per worker low as long as it is not written to (e.g. memory
+mapped arrays).
+"""
+import os
+import signal
+import socket
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+# Time in seconds to wait before replacing an exited worker, which avoids 
+# forking in a tight loop if workers fail on startup
+RESTART_DELAY = 1.0
+
+
+def _serve_worker(app, host, fd, num_threads):
+    """Serves requests with num_threads threads, each accepting connections
+    on the listening socket fd"""
+    threads = []
+    for _ in range(num_threads):
+        server = make_server(host, 0, app, fd=fd)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+
+def _fork_worker(app, host, sock, num_threads, init_worker):
+    pid = os.fork()
+    if pid != 0:
+        return pid
+
+    # Let the parent handle interrupts and stop the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    exit_code = 0
+    try:
+        if init_worker is not None:
+            init_worker()
+        _serve_worker(app, host, sock.fileno(), num_threads)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        os._exit(exit_code)
+
+
+def serve_preforked(app, host, port, num_workers, num_threads=1,
+                    init_worker=None):
+    """Serves a WSGI application with preforked worker processes
+
+    Workers which exit are replaced by new ones, until the parent process is
+    interrupted or terminated.
+
+    Args:
+    app: WSGI application
+    host: host address to listen on
+    port: port to listen on
+    num_workers: number of worker processes
+    num_threads: number of requests each worker serves concurrently
+    init_worker: function called in each worker after forking, e.g. to
+        load resources which can not be shared between processes
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, stop)
+
+    workers = set()
+    try:
+        while True:
+            while len(workers) < num_workers:
+                workers.add(_fork_worker(app, host, sock, num_threads,
+                                         init_worker))
+            pid, status = os.wait()
+            workers.discard(pid)
+            print('Worker {} exited with status {}, restarting it'.format(
+                pid, status))
+            time.sleep(RESTART_DELAY)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        sock.close()
@@ -1,2 +1,4 @@
 from src.search.search_model import SearchModel
-from src.search.search import search
+from src.search.depth import AdaptiveDepth
+from src.search.search import (search, search_stages, search_by_region, 
+                               search_feature_region, search_regions)
@@ -0,0 +1,120 @@
+"""Caching of feature maps"""
+import threading
+from collections import OrderedDict
+
+class _Loading:
+    """Result slot of a load in progress, waited on by concurrent readers"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class FeatureCache:
+    """Thread-safe LRU cache bounded by the size of its entries in bytes
+
+    Values are loaded by calling load_fn(key) on a miss. Concurrent misses
+    on the same key only load the value once, with all other callers waiting
+    for the first load to finish. Loading happens outside of the cache lock,
+    such that loads of different keys can run in parallel.
+
+    Cached arrays are shared between all callers and are therefore made
+    read-only.
+    """
+    def __init__(self, load_fn, max_bytes):
+        """
+        Args:
+        load_fn: function loading the array belonging to a key
+        max_bytes: memory budget of the cached arrays. Arrays larger than
+            the budget are returned without being cached.
+        """
+        self.load_fn = load_fn
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._num_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key, load_fn=None):
+        """Returns the value of a key, loading it if it is not cached
+
+        Args:
+        key: key of the value
+        load_fn: function loading the value of the key, overriding the load 
+            function of the cache for this call
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return self._entries[key]
+
+            self._misses += 1
+            loading = self._loading.get(key)
+            if loading is None:
+                loading = _Loading()
+                self._loading[key] = loading
+                is_loader = True
+            else:
+                is_loader = False
+
+        if not is_loader:
+            loading.done.wait()
+            if loading.error is not None:
+                raise loading.error
+            return loading.value
+
+        try:
+            value = (load_fn or self.load_fn)(key)
+            value.flags.writeable = False
+        except Exception as e:
+            loading.error = e
+            raise
+        else:
+            loading.value = value
+            self._insert(key, value)
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.done.set()
+        return value
+
+    def _insert(self, key, value):
+        with self._lock:
+            if value.nbytes > self.max_bytes or key in self._entries:
+                return
+            self._entries[key] = value
+            self._num_bytes += value.nbytes
+            while self._num_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._num_bytes -= evicted.nbytes
+                self._evictions += 1
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._num_bytes = 0
+
+    @property
+    def stats(self):
+        """Returns a dict with the number of hits, misses and evictions, and
+        the number of cached entries and bytes"""
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'entries': len(self._entries),
+                'bytes': self._num_bytes
+            }
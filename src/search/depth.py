@@ -0,0 +1,85 @@
+"""Adaptive choice of the number of results to localize and rerank"""
+import threading
+
+import numpy as np
+
+# Defaults of the adaptive depth parameters
+DEFAULT_MIN_N = 10
+DEFAULT_MAX_N = 50
+DEFAULT_MARGIN = 0.15
+DEFAULT_GAP = 0.05
+
+
+class AdaptiveDepth:
+    """Chooses how many results of the first retrieval stage to localize and
+    rerank from their similarities
+
+    Candidates whose similarity is more than margin below the similarity of
+    the best candidate are unlikely to be reranked to the top and are not
+    localized. Of the remaining candidates, only the ones before the largest
+    gap between the similarities of consecutive candidates are localized, if
+    that gap is at least gap wide, as such a gap separates the images showing
+    the query from the flat tail of the ranking. The depth is kept within
+    min_n and max_n.
+
+    Instances can be passed as localize_n to the search functions.
+    """
+    def __init__(self, min_n=DEFAULT_MIN_N, max_n=DEFAULT_MAX_N,
+                 margin=DEFAULT_MARGIN, gap=DEFAULT_GAP):
+        """
+        Args:
+        min_n: minimum number of results to localize
+        max_n: maximum number of results to localize
+        margin: maximum similarity difference to the best result of localized
+            results. If None, the margin is not considered.
+        gap: minimum similarity difference of consecutive results to cut the
+            ranking at. If None, gaps are not considered.
+        """
+        assert 0 < min_n <= max_n
+        self.min_n = min_n
+        self.max_n = max_n
+        self.margin = margin
+        self.gap = gap
+        self._lock = threading.Lock()
+        self._num_queries = 0
+        self._num_localized = 0
+        self._num_candidates = 0
+
+    def __call__(self, similarities):
+        """Returns the number of results to localize
+
+        Args:
+        similarities: similarities of the best (at most max_n) results of the
+            first retrieval stage in decreasing order
+        """
+        num_candidates = min(self.max_n, len(similarities))
+        depth = num_candidates
+        if num_candidates > self.min_n:
+            sims = np.asarray(similarities[:num_candidates])
+            if self.margin is not None:
+                depth = int(np.count_nonzero(sims >= sims[0] - self.margin))
+            if self.gap is not None and depth > self.min_n:
+                # Gaps after each candidate from the min_n-th on
+                gaps = sims[self.min_n-1:depth-1] - sims[self.min_n:depth]
+                idx = np.argmax(gaps)
+                if gaps[idx] >= self.gap:
+                    depth = self.min_n + int(idx)
+            depth = max(depth, self.min_n)
+
+        with self._lock:
+            self._num_queries += 1
+            self._num_localized += depth
+            self._num_candidates += num_candidates
+        return depth
+
+    @property
+    def stats(self):
+        """Returns a dict with the number of queries, and the number of
+        results localized and which would have been localized with a fixed
+        depth of max_n"""
+        with self._lock:
+            return {
+                'queries': self._num_queries,
+                'localized': self._num_localized,
+                'candidates': self._num_candidates
+            }
@@ -2,13 +2,14 @@ import os
 import sys
 import argparse
 import threading
+from queue import Queue
 
 import numpy as np
 
+from src.util import clip_bounding_box
 from src.features import (compute_features, compute_representation, 
                           compute_localization_representation)
 from src.search.search_model import SearchModel
-from src.search.localization_jit import localize
 
 def _descending_argsort(array, k):
     """Return indices that index the highest k values in an array"""
@@ -24,6 +25,14 @@ def _ascending_argsort(array, k):
     return indices
 
 
+def _kernel_input(features):
+    """Upcasts half precision feature maps, which the numba localization 
+    kernels do not support"""
+    if features.dtype == np.float16:
+        return features.astype(np.float32)
+    return features
+
+
 def _query(query_features, feature_store, top_n=0):
     """Query stored features for similarity against a passed feature
 
@@ -51,34 +60,94 @@ def _query(query_features, feature_store, top_n=0):
     return indices, similarity[indices]
 
 
+def _query_candidates(query_repr, feature_store, localize, localize_n):
+    """Runs the first retrieval stage
+
+    Args:
+    query_repr: representation of the search query
+    feature_store: 2D-array of n features to compare to, shape (n, dim)
+    localize: if False, all entries are returned
+    localize_n: number of entries to return, or a function choosing it from
+        the similarities of up to localize_n.max_n best entries, such as 
+        AdaptiveDepth
+
+    Returns: (indices, similarities) as returned by _query
+    """
+    if not localize:
+        return _query(query_repr, feature_store)
+    if callable(localize_n):
+        indices, similarities = _query(query_repr, feature_store, 
+                                       localize_n.max_n)
+        depth = localize_n(similarities)
+        return indices[:depth], similarities[:depth]
+    return _query(query_repr, feature_store, localize_n)
+
+
 def _localize_parallel(search_model, query_features, feature_idxs, image_shape,
-                       n_threads=8):
+                       n_threads=8, prefetched=None, on_localized=None, 
+                       reprs=None, stop=None):
     """Localizes where a query occurs on a number of features
 
+    Feature maps are localized in the order in which they finish loading, 
+    such that loading and localization overlap.
+
     Args:
     search_model: instance of the SearchModel class
     query_features: features of the image to query for
     features_idxs: N indices of the features to query on
     image_shape: shape of the query image in the form of (height, width)
     n_threads: number of threads to use in parallel
+    prefetched: list of N futures of the feature maps as returned by 
+        search_model.prefetch_features. If None, the prefetch is started here.
+    on_localized: optional function called with the position in feature_idxs 
+        and the bounding box of each feature map as soon as it is localized
+    reprs: optional array of shape (N, D), into which the representations 
+        of the bounding boxes are computed by the localizing threads
+    stop: optional threading.Event, after which is set no further feature 
+        maps are localized. The bounding boxes of those are left undefined.
 
     Returns: array of N bounding boxes in the form of (left, upper, 
         right, lower).
     """
-    def f(res, feature_idxs):
-        for idx, feature_idx in enumerate(feature_idxs):
-            features = search_model.get_features(feature_idx)
-            res[idx] = localize(localization_repr, features, image_shape)
+    # Imported here as numba is slow to import and only needed for localization
+    from src.search.localization_jit import localize
+
+    if prefetched is None:
+        prefetched = search_model.prefetch_features(feature_idxs)
+
+    loaded = Queue()
+    def enqueue(idx):
+        return lambda future: loaded.put((idx, future))
+    for idx, future in enumerate(prefetched):
+        future.add_done_callback(enqueue(idx))
+
+    def f(res, num_features):
+        for _ in range(num_features):
+            idx, future = loaded.get()
+            if stop is not None and stop.is_set():
+                return
+            features = future.result()
+            res[idx] = localize(localization_repr, _kernel_input(features), 
+                                image_shape)
+            if reprs is not None:
+                x1, y1, x2, y2 = res[idx]
+                reprs[idx] = compute_representation(
+                    features[y1:y2+1, x1:x2+1], search_model.pca)
+            if on_localized is not None:
+                on_localized(idx, res[idx])
 
     localization_repr = compute_localization_representation(query_features)
     bounding_boxes = np.empty(len(feature_idxs), dtype=(int, 4))
 
+    # Each thread localizes a fixed share of the feature maps, taking the 
+    # next loaded feature map from the queue
     threads = []
-    chunk_len = int(np.ceil(len(feature_idxs) / n_threads))
-    for i in range(n_threads):
-        args = [bounding_boxes[i * chunk_len:(i + 1) * chunk_len],
-                feature_idxs[i * chunk_len:(i + 1) * chunk_len]]
-        threads.append(threading.Thread(target=f, args=args))
+    shares = np.full(n_threads, len(feature_idxs) // n_threads, dtype=int)
+    shares[:len(feature_idxs) % n_threads] += 1
+    for share in shares:
+        if share > 0:
+            threads.append(threading.Thread(target=f, args=[bounding_boxes, 
+                                                            share]))
 
     for thread in threads:
         thread.start()
@@ -100,39 +169,17 @@ def _localize(search_model, query_features, feature_idxs, image_shape):
     Returns: array of N bounding boxes in the form of (left, upper, 
         right, lower).
     """
+    from src.search.localization_jit import localize
+
     localization_repr = compute_localization_representation(query_features)
     bounding_boxes = np.empty(len(feature_idxs), dtype=(int, 4))
     for idx, feature_idx in enumerate(feature_idxs):
-        features = search_model.get_features(feature_idx)
+        features = _kernel_input(search_model.get_features(feature_idx))
         bounding_boxes[idx] = localize(localization_repr, features, image_shape)
 
     return bounding_boxes
 
 
-def _compute_bbox_reprs(search_model, bounding_boxes, feature_idxs):
-    """Computes representations for bounding boxes on feature maps
-
-    Args:
-    search_model: instance of the SearchModel class
-    bounding_boxes: list of N bounding boxes in the form of (left, upper, 
-        right, lower)
-    feature_idxs: list of N indices specifying the feature maps for 
-        each bounding box
-
-    Returns: array of represesentations in the shape of (N, D), where D is 
-        the representation size
-    """
-    repr_size = search_model.feature_store.shape[-1]
-    bounding_box_reprs = np.empty((len(feature_idxs), repr_size))
-    for idx, bbox in enumerate(bounding_boxes):
-        x1, y1, x2, y2 = bbox
-        features = search_model.get_features(feature_idxs[idx])
-        bbox_repr = compute_representation(features[y1:y2+1, x1:x2+1],
-                                           search_model.pca)
-        bounding_box_reprs[idx] = bbox_repr
-    return bounding_box_reprs
-
-
 def _average_query_exp(query_repr, feature_reprs, feature_idxs, top_n=5):
     """Performs average query expansion
 
@@ -164,7 +211,7 @@ def _map_bboxes(search_model, bboxes, features_idxs):
 
     The mapping scales the box by the ratio between image and feature map size.
     As we have no way (yet) to deduct the feature map shape directly from an 
-    image size for a specific model, we cache the feature map sizes in the 
+    image size for a specific model, the feature map sizes are stored in the 
     feature metadata.
 
     Args:
@@ -176,16 +223,167 @@ def _map_bboxes(search_model, bboxes, features_idxs):
 
     Returns: list of N bounding boxes in the form of (left, upper, right, lower)
     """
-    mapped_bboxes = []
-    for bbox, feature_idx in zip(bboxes, features_idxs):
-        metadata = search_model.get_metadata(feature_idx)
-        scale_x = metadata['width'] / float(metadata['feature_width'])
-        scale_y = metadata['height'] / float(metadata['feature_height'])
-        mapped_bboxes.append((round(bbox.item(0)*scale_x), 
-                              round(bbox.item(1)*scale_y), 
-                              round(bbox.item(2)*scale_x), 
-                              round(bbox.item(3)*scale_y)))
-    return mapped_bboxes
+    features_idxs = np.asarray(features_idxs, dtype=np.int64)
+    metadata = search_model.feature_metadata
+    image_sizes = np.stack((metadata.column('width')[features_idxs],
+                            metadata.column('height')[features_idxs]), axis=1)
+    feature_sizes = search_model.get_feature_shapes(features_idxs)[:, ::-1]
+
+    scales = np.tile(image_sizes / feature_sizes.astype(float), 2)
+    mapped_bboxes = np.round(bboxes * scales).astype(int)
+    return [tuple(bbox) for bbox in mapped_bboxes.tolist()]
+
+
+def crop_features(features, image_shape, bounding_box):
+    """Crops a feature map to a region of the image it was computed on
+
+    Args:
+    features: feature map of shape (height, width, depth)
+    image_shape: shape of the image in the form of (height, width)
+    bounding_box: region on the image in the form of (left, upper, 
+        right+1, lower+1)
+
+    Returns: (features, image_shape), where features is the part of the 
+        feature map covering the region, and image_shape is the shape of 
+        the region in the form of (height, width)
+    """
+    height, width = image_shape
+    x1, y1, x2, y2 = clip_bounding_box(bounding_box, image_shape)
+
+    feature_height, feature_width = features.shape[:2]
+    scale_x, scale_y = feature_width / width, feature_height / height
+    fx1, fy1 = int(np.floor(x1 * scale_x)), int(np.floor(y1 * scale_y))
+    fx2, fy2 = int(np.ceil(x2 * scale_x)), int(np.ceil(y2 * scale_y))
+    return features[fy1:fy2, fx1:fx2], (y2 - y1, x2 - x1)
+
+
+def _search_stages(search_model, query_features, image_shape, top_n, 
+                   localize, localize_n, rerank, avg_qe):
+    """Runs the search for a query feature map, yielding results as soon as 
+    they are available
+
+    Args:
+    query_features: feature map of the query
+    image_shape: shape of the query image in the form of (height, width)
+
+    See search for the other arguments.
+
+    Yields: tuples of (stage, results), in the order
+        ('ranking', (indices, similarities)) with the (top_n) results of the 
+            first retrieval stage,
+        ('localization', (index, bounding_box, similarity)) for each 
+            localized image in the order in which its localization finishes, 
+            with the bounding box in image coordinates and the similarity of 
+            the bounding box if reranking, None otherwise,
+        ('result', (indices, similarities, bounding_boxes)) with the final 
+            results as returned by search.
+    """
+    assert top_n >= 0
+    if rerank:
+        assert localize, 'Rerank implies localization'
+
+    bboxes = None
+    reprs = search_model.feature_store
+
+    query_repr = compute_representation(query_features, search_model.pca)
+
+    feature_idxs, sims = _query_candidates(query_repr, reprs, localize, 
+                                           localize_n)
+    idxs = feature_idxs
+
+    num_ranked = top_n if top_n > 0 else len(feature_idxs)
+    yield 'ranking', (feature_idxs[:num_ranked], sims[:num_ranked])
+
+    if localize:
+        localized = Queue()
+        stop = threading.Event()
+        bboxes = np.empty(len(idxs), dtype=(int, 4))
+        bbox_reprs = None
+        if rerank:
+            bbox_reprs = np.empty((len(idxs), reprs.shape[-1]))
+
+        # Load the candidate feature maps while the localization starts
+        prefetched = search_model.prefetch_features(idxs)
+
+        def run_localization():
+            try:
+                _localize_parallel(search_model, query_features, idxs, 
+                                   image_shape, prefetched=prefetched,
+                                   on_localized=lambda idx, bbox: 
+                                   localized.put((idx, bbox)),
+                                   reprs=bbox_reprs, stop=stop)
+            finally:
+                localized.put(None)
+
+        thread = threading.Thread(target=run_localization, daemon=True)
+        thread.start()
+
+        num_localized = 0
+        try:
+            for idx, bbox in iter(localized.get, None):
+                bboxes[idx] = bbox
+                num_localized += 1
+
+                similarity = None
+                if rerank:
+                    similarity = bbox_reprs[idx].dot(query_repr.ravel())
+                image_bbox = _map_bboxes(search_model, bboxes[idx:idx+1], 
+                                         idxs[idx:idx+1])[0]
+                yield 'localization', (idxs[idx], image_bbox, similarity)
+        finally:
+            # If the generator is closed early, the localization is stopped 
+            # and waited for, such that no work outlives the search
+            stop.set()
+            for future in prefetched:
+                future.cancel()
+            thread.join()
+
+        if num_localized < len(idxs):
+            raise RuntimeError('Localization failed on {} of {} '
+                               'images'.format(len(idxs) - num_localized, 
+                                               len(idxs)))
+
+    # Positions of the results in feature_idxs
+    idxs = np.arange(len(feature_idxs))
+    if rerank:
+        reprs = bbox_reprs
+        idxs, sims = _query(query_repr, reprs)
+    elif localize:
+        reprs = reprs[feature_idxs]
+
+    if avg_qe:
+        if localize:
+            idxs, sims = _average_query_exp(query_repr, reprs, idxs)
+        else:
+            # Expands over the whole feature store, whose indices are the 
+            # results
+            feature_idxs, sims = _average_query_exp(query_repr, reprs, 
+                                                    feature_idxs)
+
+    if top_n > 0:
+        idxs = idxs[:top_n]
+
+    if localize:
+        bboxes = _map_bboxes(search_model, bboxes[idxs], feature_idxs[idxs])
+
+    yield 'result', (feature_idxs[idxs], sims, bboxes)
+
+
+def _search_features(search_model, query_features, image_shape, top_n, 
+                     localize, localize_n, rerank, avg_qe):
+    """Search the feature store for a query feature map
+
+    Args:
+    query_features: feature map of the query
+    image_shape: shape of the query image in the form of (height, width)
+
+    See search for the other arguments and the return values.
+    """
+    for stage, results in _search_stages(search_model, query_features, 
+                                         image_shape, top_n, localize, 
+                                         localize_n, rerank, avg_qe):
+        pass
+    return results
 
 
 def search(search_model, query, top_n=0, localize=True, localize_n=50, 
@@ -198,7 +396,8 @@ def search(search_model, query, top_n=0, localize=True, localize_n=50,
     roi: bounding box in the form of (left, upper, right, lower)
     top_n: how many query results to return. top_n=0 returns all results
     localize: perform localization of objects, i.e. find bounding boxes
-    localize_n: how many top images to perform localization on
+    localize_n: how many top images to perform localization on, or an 
+        AdaptiveDepth choosing it from the similarities of the top images
     rerank: rerank images after localization by using representations 
         on the found bounding boxes
     avg_qe: perform average query expansion
@@ -211,35 +410,84 @@ def search(search_model, query, top_n=0, localize=True, localize_n=50,
         specifying the rough location of the found objects if localizing, 
         None otherwise.
     """
-    assert top_n >= 0
-    if rerank:
-        assert localize, 'Rerank implies localization'
+    query_features = compute_features(search_model.model, query)
+    return _search_features(search_model, query_features, query.shape[:2],
+                            top_n, localize, localize_n, rerank, avg_qe)
 
-    bboxes = None
-    reprs = search_model.feature_store
 
+def search_stages(search_model, query, top_n=0, localize=True, localize_n=50, 
+                  rerank=True, avg_qe=True):
+    """Search the feature store for a query, yielding results as soon as they 
+    are available
+
+    See search for the arguments and _search_stages for the yielded results.
+    """
     query_features = compute_features(search_model.model, query)
-    query_repr = compute_representation(query_features, search_model.pca)
+    return _search_stages(search_model, query_features, query.shape[:2],
+                          top_n, localize, localize_n, rerank, avg_qe)
 
-    retrieval_n = localize_n if localize else 0
-    feature_idxs, sims = _query(query_repr, reprs, retrieval_n)
-    idxs = feature_idxs
 
-    if localize:
-        bboxes = _localize_parallel(search_model, query_features, idxs, 
-                                    query.shape[:2])
+def search_feature_region(search_model, features, image_shape, bounding_box,
+                          top_n=0, localize=True, localize_n=50, rerank=True, 
+                          avg_qe=True):
+    """Search the feature store for a region of a precomputed feature map
 
-    if rerank:
-        reprs = _compute_bbox_reprs(search_model, bboxes, idxs)
-        idxs, sims = _query(query_repr, reprs)
+    Args:
+    search_model: instance of the SearchModel class
+    features: feature map of a whole image as computed by compute_features
+    image_shape: shape of the image in the form of (height, width)
+    bounding_box: region on the image in the form of (left, upper, 
+        right+1, lower+1)
 
-    if avg_qe:
-        idxs, sims = _average_query_exp(query_repr, reprs, idxs)
+    See search for the other arguments and the return values.
+    """
+    query_features, region_shape = crop_features(features, image_shape,
+                                                 bounding_box)
+    return _search_features(search_model, query_features, region_shape,
+                            top_n, localize, localize_n, rerank, avg_qe)
 
-    if top_n > 0:
-        idxs = idxs[:top_n]
 
-    if localize:
-        bboxes = _map_bboxes(search_model, bboxes[idxs], feature_idxs[idxs])
+def search_regions(search_model, image, bounding_boxes, top_n=0, localize=True,
+                   localize_n=50, rerank=True, avg_qe=True):
+    """Search the feature store for several regions of one image, whose 
+    queries are cropped from the feature map of the whole image
 
-    return feature_idxs[idxs], sims, bboxes
+    Args:
+    search_model: instance of the SearchModel class
+    image: array in the shape of (height, width, 3)
+    bounding_boxes: list of regions on the image in the form of (left, 
+        upper, right+1, lower+1)
+
+    See search for the other arguments.
+
+    Returns: list of the results of each region as returned by search
+    """
+    features = compute_features(search_model.model, image)
+    return [search_feature_region(search_model, features, image.shape[:2], 
+                                  bounding_box, top_n, localize, localize_n, 
+                                  rerank, avg_qe)
+            for bounding_box in bounding_boxes]
+
+
+def search_by_region(search_model, feature_idx, bounding_box, top_n=0, 
+                     localize=True, localize_n=50, rerank=True, avg_qe=True):
+    """Search the feature store for a region of an already indexed image
+
+    Instead of computing features on the query image, the query features 
+    are cropped from the stored feature map of the image, which avoids 
+    running the model.
+
+    Args:
+    search_model: instance of the SearchModel class
+    feature_idx: index of the image in the feature store
+    bounding_box: region on the image in the form of (left, upper, 
+        right+1, lower+1)
+
+    See search for the other arguments and the return values.
+    """
+    metadata = search_model.get_metadata(feature_idx)
+    image_shape = (metadata['height'], metadata['width'])
+    features = search_model.get_features(feature_idx)
+    return search_feature_region(search_model, features, image_shape, 
+                                 bounding_box, top_n, localize, localize_n, 
+                                 rerank, avg_qe)
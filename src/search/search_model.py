@@ -1,84 +1,162 @@
-import json
-from os.path import basename, join, isfile
-from functools import lru_cache
+import threading
+from os.path import basename, join
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-from sklearn.externals import joblib
 
 from src.database import Database
 from src.models import load_model
-from src.features import representation_size
+from src.features import (representation_size, feature_file_path, 
+                          load_features, load_feature_shape, load_whitening, 
+                          FeatureMetadata)
+from src.search.cache import FeatureCache
+
+# Default memory budget of the feature map cache in megabytes
+DEFAULT_FEATURE_CACHE_MB = 512
+# Default number of threads loading feature maps in the background
+DEFAULT_PREFETCH_THREADS = 8
 
 class SearchModel:
     """Encapsulates all components necessary to search on a database"""
     @staticmethod
-    def from_config(config):
+    def from_config(config, lazy_model=False):
         """Constructs a search model from a config dictionary"""
         if 'model' not in config or 'features' not in config:
             raise ValueError('Search model needs model and features parameters')
         database = config.get('database')
-        return SearchModel(config['model'], config['features'], database)
-
-    def __init__(self, model, features_path, database_path=None):
-        # Load the extraction model
-        self.model = load_model(model)
+        model_cache = config.get('model_cache', '')
+        feature_cache_mb = config.get('feature_cache_mb', 
+                                      DEFAULT_FEATURE_CACHE_MB)
+        prefetch_threads = config.get('prefetch_threads', 
+                                      DEFAULT_PREFETCH_THREADS)
+        return SearchModel(config['model'], config['features'], database,
+                           model_cache, feature_cache_mb, prefetch_threads,
+                           lazy_model)
 
+    def __init__(self, model, features_path, database_path=None, 
+                 model_cache='', feature_cache_mb=DEFAULT_FEATURE_CACHE_MB,
+                 prefetch_threads=DEFAULT_PREFETCH_THREADS, lazy_model=False):
+        """
+        Args:
+        lazy_model: defer loading the extraction model to its first use. 
+            Needed to fork processes sharing the search model, as the 
+            model backends do not support being used after a fork.
+        """
         # Load the feature metadata
         features_basename = basename(features_path)
         meta_file_path = join(features_path, 
                               '{}.meta'.format(features_basename))
-        with open(meta_file_path, 'r') as f:
-            self.feature_metadata = json.load(f)
+        self.feature_metadata = FeatureMetadata.load(meta_file_path)
         
-        # Load image representations
+        # Load image representations memory mapped, such that processes 
+        # share them through the page cache
         repr_file_path = join(features_path, 
                               '{}.repr.npy'.format(features_basename))
-        self.feature_store = np.load(repr_file_path)
-
-        if representation_size(self.model) != self.feature_store.shape[-1]:
-            raise ValueError('Model {} and feature store {} have nonmatching '
-                             'representation sizes: {} vs {}'.format(
-                                model, features_path,
-                                representation_size(self.model),
-                                self.feature_store.shape[-1]))
+        self.feature_store = np.load(repr_file_path, mmap_mode='r')
 
-        # Construct paths to feature files
-        self.feature_file_paths = {} 
-        features_sub_folder = join(features_path, 'features/')
-        for idx, metadata in self.feature_metadata.items():
-            if not idx.isdigit():
-                continue
-            image_name = basename(self.feature_metadata[str(idx)]['image'])
-            path = join(features_sub_folder, '{}.npy'.format(image_name))
-            if isfile(path):
-                self.feature_file_paths[str(idx)] = path
-            else:
-                print('Missing feature file for image {}'.format(image_name))
+        self.features_path = features_path
+        self.feature_format = self.feature_metadata.get('feature_format', 
+                                                        'dense')
+        # Shapes of feature maps read from their files, which is only needed 
+        # for metadata of older versions not containing the shapes
+        self.feature_shapes = {}
+        # Feature maps are loaded concurrently by the localization threads
+        self.feature_cache = FeatureCache(self._load_features, 
+                                          int(feature_cache_mb * 2**20))
+        # The prefetch thread pool is created on first use
+        self.prefetch_threads = prefetch_threads
+        self._prefetch_executor = None
+        self._prefetch_lock = threading.Lock()
 
         # Load PCA
         pca_file_path = join(features_path, '{}.pca'.format(features_basename))
-        if isfile(pca_file_path):
-            self.pca = joblib.load(pca_file_path)
-        else:
-            self.pca = None
+        self.pca = load_whitening(pca_file_path)
 
         # Load image database
         if database_path:
             self.database = Database.load(database_path)
         else:
             self.database = None
+
+        # Load the extraction model
+        self.model_name = model
+        self.model_cache = model_cache
+        self._model = None
+        self._model_lock = threading.Lock()
+        if not lazy_model:
+            self._load_model()
+
+    def _load_model(self):
+        model = load_model(self.model_name, self.model_cache)
+        if representation_size(model) != self.feature_store.shape[-1]:
+            raise ValueError('Model {} and feature store {} have nonmatching '
+                             'representation sizes: {} vs {}'.format(
+                                self.model_name, self.features_path,
+                                representation_size(model),
+                                self.feature_store.shape[-1]))
+        self._model = model
+
+    @property
+    def model(self):
+        """The extraction model, which is loaded on first use if the search 
+        model was constructed with lazy_model"""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    self._load_model()
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
         
     def get_metadata(self, feature_idx):
-        return self.feature_metadata[str(feature_idx)]
+        return self.feature_metadata[feature_idx]
+
+    def get_feature_file_path(self, feature_idx):
+        image_path = self.feature_metadata.image(feature_idx)
+        return feature_file_path(self.features_path, image_path, 
+                                 self.feature_format)
+
+    def _load_features(self, feature_idx):
+        return load_features(self.get_feature_file_path(feature_idx))
 
-    @lru_cache(maxsize=128)
     def get_features(self, feature_idx):
-        feature_idx = str(feature_idx)
-        feature_file_path = self.feature_file_paths[feature_idx]
-        features = np.load(feature_file_path)
-        self.feature_metadata[feature_idx]['feature_height'] = features.shape[0]
-        self.feature_metadata[feature_idx]['feature_width'] = features.shape[1]
-        return features
+        """Returns the (read-only) feature map of an image"""
+        return self.feature_cache.get(int(feature_idx))
+
+    def prefetch_features(self, feature_idxs):
+        """Starts loading feature maps into the feature cache in the background
+
+        Returns: list of futures, each resolving to the feature map of the 
+            corresponding index
+        """
+        with self._prefetch_lock:
+            if self._prefetch_executor is None:
+                self._prefetch_executor = ThreadPoolExecutor(
+                    max_workers=self.prefetch_threads)
+        return [self._prefetch_executor.submit(self.get_features, feature_idx)
+                for feature_idx in feature_idxs]
+
+    def get_feature_shapes(self, feature_idxs):
+        """Returns the shapes of feature maps without loading them
+
+        Returns: array of shape (N, 2), containing the height and width of 
+            the feature map of each of the N indices
+        """
+        feature_idxs = np.asarray(feature_idxs, dtype=np.int64)
+        columns = self.feature_metadata.columns
+        if 'feature_height' in columns and 'feature_width' in columns:
+            return np.stack((columns['feature_height'][feature_idxs],
+                             columns['feature_width'][feature_idxs]), axis=1)
+
+        shapes = []
+        for feature_idx in feature_idxs.tolist():
+            if feature_idx not in self.feature_shapes:
+                path = self.get_feature_file_path(feature_idx)
+                self.feature_shapes[feature_idx] = load_feature_shape(path)[:2]
+            shapes.append(self.feature_shapes[feature_idx])
+        return np.array(shapes, dtype=np.int64).reshape(-1, 2)
 
     def query_database(self, image):
         if self.database:
@@ -0,0 +1,314 @@
+"""Search server owning a search model, shared by several client processes
+
+The server listens on a Unix socket and runs the requests of each client
+connection on its own thread. Arrays larger than SHARED_ARRAY_MIN_BYTES
+are not sent through the socket, but written to a file in shared memory
+(/dev/shm), which the receiver maps into its address space and removes.
+
+As messages are pickled, only clients knowing the authentication key of the
+server may connect. The server writes a random key to a file next to its 
+socket, readable only by the user running the server, from which the 
+clients of the same user read it.
+"""
+import os
+import pickle
+import tempfile
+import threading
+from os.path import isdir, exists
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+
+from src.features import FeatureMetadata
+from src.search.search import (search, search_by_region,
+                               search_feature_region, search_regions)
+
+# Arrays from this size on are passed through shared memory
+SHARED_ARRAY_MIN_BYTES = 64 * 1024
+
+SHARED_MEMORY_DIR = '/dev/shm' if isdir('/dev/shm') else tempfile.gettempdir()
+SHARED_ARRAY_PREFIX = 'search_'
+
+AUTHKEY_SIZE = 32
+
+
+def authkey_path(address):
+    """Returns the path of the file holding the authentication key of the 
+    server listening on address"""
+    return address + '.key'
+
+
+def _check_shared_path(path):
+    """Returns the real path of a shared array file, making sure that it is 
+    a file created by SharedArray, such that peers can not make the 
+    receiver map or remove any other file
+
+    Raises: ValueError if the path is not valid
+    """
+    real_path = os.path.realpath(path)
+    directory, name = os.path.split(real_path)
+    if directory != os.path.realpath(SHARED_MEMORY_DIR) \
+        or not name.startswith(SHARED_ARRAY_PREFIX) \
+        or not name.endswith('.npy'):
+        raise ValueError('Invalid shared array path {}'.format(path))
+    return real_path
+
+
+class SharedArray:
+    """Reference to an array stored in a shared memory file"""
+    def __init__(self, array):
+        fd, self.path = tempfile.mkstemp(dir=SHARED_MEMORY_DIR,
+                                         prefix=SHARED_ARRAY_PREFIX, 
+                                         suffix='.npy')
+        os.close(fd)
+        shared = np.lib.format.open_memmap(self.path, mode='w+',
+                                           dtype=array.dtype,
+                                           shape=array.shape)
+        shared[...] = array
+        del shared
+
+    def load(self):
+        """Maps the array copy-on-write and removes its file, which can only
+        be done once"""
+        path = _check_shared_path(self.path)
+        try:
+            return np.load(path, mmap_mode='c')
+        finally:
+            os.remove(path)
+
+    def discard(self):
+        """Removes the file of an array which is not going to be loaded"""
+        try:
+            os.remove(_check_shared_path(self.path))
+        except (OSError, ValueError):
+            pass
+
+
+def _pack(value):
+    """Replaces large arrays in a (possibly nested) message by SharedArrays"""
+    if isinstance(value, np.ndarray):
+        if value.nbytes >= SHARED_ARRAY_MIN_BYTES:
+            return SharedArray(value)
+        return value
+    elif isinstance(value, (list, tuple)):
+        return type(value)(_pack(v) for v in value)
+    elif isinstance(value, dict):
+        return {k: _pack(v) for k, v in value.items()}
+    return value
+
+
+def _unpack(value):
+    if isinstance(value, SharedArray):
+        return value.load()
+    elif isinstance(value, (list, tuple)):
+        return type(value)(_unpack(v) for v in value)
+    elif isinstance(value, dict):
+        return {k: _unpack(v) for k, v in value.items()}
+    return value
+
+
+def _discard(value):
+    """Removes the files of the SharedArrays in a message which failed to be
+    transferred or unpacked"""
+    if isinstance(value, SharedArray):
+        value.discard()
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _discard(v)
+    elif isinstance(value, dict):
+        for v in value.values():
+            _discard(v)
+
+
+class SearchServer:
+    """Serves search requests on a Unix socket
+
+    Supported requests are the model prediction, the search functions of
+    src.search, and database lookups.
+    """
+    def __init__(self, search_model, address, authkey=None):
+        """
+        Args:
+        search_model: instance of the SearchModel class
+        address: path of the Unix socket to listen on
+        authkey: key clients need to connect. If None, a random key is 
+            generated and written to authkey_path(address).
+        """
+        self.search_model = search_model
+        self.address = address
+        self.authkey = authkey
+
+    def _handle(self, method, args, kwargs):
+        search_model = self.search_model
+        if method == 'info':
+            # The path may be relative to the working directory of the server
+            return {
+                'features_path': os.path.abspath(search_model.features_path),
+                'output_shape': search_model.model.output_shape
+            }
+        elif method == 'predict':
+            return search_model.model.predict(*args, **kwargs)
+        elif method == 'search':
+            return search(search_model, *args, **kwargs)
+        elif method == 'search_by_region':
+            return search_by_region(search_model, *args, **kwargs)
+        elif method == 'search_feature_region':
+            return search_feature_region(search_model, *args, **kwargs)
+        elif method == 'search_regions':
+            return search_regions(search_model, *args, **kwargs)
+        elif method == 'query_database':
+            return search_model.query_database(*args, **kwargs)
+        raise ValueError('Unknown method {}'.format(method))
+
+    def _serve_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    method, args, kwargs = conn.recv()
+                except EOFError:
+                    return
+
+                try:
+                    response = ('ok', _pack(self._handle(
+                        method, _unpack(args), _unpack(kwargs))))
+                except Exception as e:
+                    _discard((args, kwargs))
+                    response = ('error', e)
+
+                try:
+                    conn.send(response)
+                except pickle.PicklingError:
+                    _discard(response)
+                    conn.send(('error', RuntimeError(repr(response[1]))))
+                except OSError:
+                    _discard(response)
+                    return
+
+    def _write_authkey(self):
+        """Writes a new random authentication key, readable by the owner only
+        """
+        self.authkey = os.urandom(AUTHKEY_SIZE)
+        path = authkey_path(self.address)
+        if exists(path):
+            os.remove(path)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.authkey)
+
+    def serve_forever(self):
+        if exists(self.address):  # Remove socket of a previous server
+            os.remove(self.address)
+        if self.authkey is None:
+            self._write_authkey()
+
+        with Listener(self.address, family='AF_UNIX',
+                      authkey=self.authkey) as listener:
+            os.chmod(self.address, 0o600)
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, EOFError, OSError):
+                    continue  # Client failed to authenticate
+                thread = threading.Thread(target=self._serve_connection,
+                                          args=[conn], daemon=True)
+                thread.start()
+
+
+class _RemoteModel:
+    """Model whose predictions are computed by the search server"""
+    def __init__(self, client, output_shape):
+        self.client = client
+        self.output_shape = output_shape
+
+    def predict(self, data):
+        return self.client._call('predict', data)
+
+
+class SearchClient:
+    """Client of a SearchServer
+
+    Provides the parts of the SearchModel interface needed to search and to
+    present results, such that it can be used in place of a SearchModel
+    with the methods search, search_stages, search_by_region, 
+    search_feature_region and search_regions replacing the functions of the
+    same names. The methods searching images send the image to the server, 
+    which computes its feature map, such that feature maps do not cross 
+    the socket. The feature metadata is
+    loaded memory mapped by the client itself.
+
+    Each thread uses its own connection, such that requests of several
+    threads are served in parallel.
+    """
+    def __init__(self, address, authkey=None):
+        """
+        Args:
+        address: path of the Unix socket of the server
+        authkey: authentication key of the server. If None, it is read from
+            authkey_path(address).
+        """
+        self.address = address
+        if authkey is None:
+            with open(authkey_path(address), 'rb') as f:
+                authkey = f.read()
+        self.authkey = authkey
+        self._local = threading.local()
+
+        info = self._call('info')
+        features_path = info['features_path']
+        meta_file_path = os.path.join(features_path, '{}.meta'.format(
+            os.path.basename(features_path)))
+        self.feature_metadata = FeatureMetadata.load(meta_file_path)
+        self.model = _RemoteModel(self, info['output_shape'])
+
+    def _call(self, method, *args, **kwargs):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = Client(self.address, family='AF_UNIX', 
+                          authkey=self.authkey)
+            self._local.conn = conn
+
+        request = (method, _pack(args), _pack(kwargs))
+        try:
+            conn.send(request)
+            status, value = conn.recv()
+        except BaseException:
+            # Files of arrays the server loaded are removed already
+            _discard(request)
+            self._local.conn = None
+            conn.close()
+            raise
+
+        if status == 'error':
+            raise value
+        try:
+            return _unpack(value)
+        except BaseException:
+            _discard(value)
+            raise
+
+    def get_metadata(self, feature_idx):
+        return self.feature_metadata[feature_idx]
+
+    def query_database(self, image):
+        return self._call('query_database', image)
+
+    def search(self, query, **kwargs):
+        return self._call('search', query, **kwargs)
+
+    def search_by_region(self, feature_idx, bounding_box, **kwargs):
+        return self._call('search_by_region', feature_idx, bounding_box,
+                          **kwargs)
+
+    def search_feature_region(self, features, image_shape, bounding_box,
+                              **kwargs):
+        return self._call('search_feature_region', features, image_shape,
+                          bounding_box, **kwargs)
+
+    def search_regions(self, image, bounding_boxes, **kwargs):
+        return self._call('search_regions', image, bounding_boxes, **kwargs)
+
+    def search_stages(self, query, **kwargs):
+        """Returns an iterator over the final results of search as its only
+        stage, as intermediate results are not forwarded by the server"""
+        return iter([('result', self.search(query, **kwargs))])
@@ -0,0 +1,237 @@
+"""Search sessions localizing and reranking results page by page"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+from src.features import compute_features, compute_representation
+from src.search.search import (_query, _query_candidates, _localize_parallel,
+                               _average_query_exp,
+                               _map_bboxes)
+
+DEFAULT_PAGE_SIZE = 5
+DEFAULT_SESSION_TTL = 600
+DEFAULT_MAX_SESSIONS = 1000
+DEFAULT_MAX_SESSION_MB = 256
+
+
+class SearchSession:
+    """Search whose results are localized and reranked on demand
+
+    The first retrieval stage ranks localize_n candidates once. Each page
+    requested beyond the pages served so far localizes the next page_size
+    candidates of this ranking, reranks all localized candidates which have
+    not been served yet, and serves the best page_size of them. Thus only as
+    many candidates are localized as results are viewed, while the pages
+    served before stay unchanged. If all candidates fit on the first page,
+    its results are the same as the ones of search with top_n=localize_n.
+    The query feature map is released once all candidates are localized.
+    """
+    def __init__(self, search_model, query_features, image_shape,
+                 page_size=DEFAULT_PAGE_SIZE, localize=True, localize_n=50,
+                 rerank=True, avg_qe=True):
+        """
+        Args:
+        search_model: instance of the SearchModel class
+        query_features: feature map of the query
+        image_shape: shape of the query image in the form of (height, width)
+        page_size: number of results per page
+
+        See search for the other arguments.
+        """
+        assert page_size > 0
+        if rerank:
+            assert localize, 'Rerank implies localization'
+
+        self.search_model = search_model
+        self.query_features = query_features
+        self.image_shape = image_shape
+        self.page_size = page_size
+        self.localize = localize
+        self.rerank = rerank
+        self.avg_qe = avg_qe
+        self.last_access = time.monotonic()
+        self._lock = threading.Lock()
+
+        self.query_repr = compute_representation(query_features,
+                                                 search_model.pca)
+        reprs = search_model.feature_store
+
+        self.candidates, sims = _query_candidates(self.query_repr, reprs,
+                                                  localize, localize_n)
+
+        # Positions in candidates and similarities of the served results
+        self._served = []
+        self._served_sims = []
+        self._num_localized = 0
+
+        if not localize:
+            # Without localization, all results are known up front
+            idxs = np.arange(len(self.candidates))
+            if avg_qe:
+                idxs, sims = _average_query_exp(self.query_repr, reprs,
+                                                self.candidates)
+                self.candidates = idxs
+                idxs = np.arange(len(idxs))
+            self._served = idxs
+            self._served_sims = sims
+            self._num_localized = len(self.candidates)
+            self.query_features = None
+            return
+
+        num_candidates = len(self.candidates)
+        self._bboxes = np.empty(num_candidates, dtype=(int, 4))
+        self._reprs = np.empty((num_candidates, reprs.shape[-1]))
+        self._is_served = np.zeros(num_candidates, dtype=bool)
+
+    @property
+    def num_results(self):
+        """Total number of results of the session"""
+        return len(self.candidates)
+
+    @property
+    def num_pages(self):
+        return -(-self.num_results // self.page_size)
+
+    @property
+    def num_localized(self):
+        """Number of candidates localized so far"""
+        return self._num_localized
+
+    @property
+    def nbytes(self):
+        """Approximate memory size of the session's arrays in bytes"""
+        nbytes = self.candidates.nbytes + 16 * len(self._served)
+        if self.query_features is not None:
+            nbytes += self.query_features.nbytes
+        if self.localize:
+            nbytes += (self._bboxes.nbytes + self._reprs.nbytes 
+                       + self._is_served.nbytes)
+        return nbytes
+
+    def page(self, page):
+        """Returns the results of a page, localizing further candidates if
+        needed
+
+        Args:
+        page: zero-based number of the page
+
+        Returns: (indices, similarities, bounding_boxes) as returned by
+            search, which are empty if the page is past the last result
+        """
+        with self._lock:
+            self.last_access = time.monotonic()
+            start = page * self.page_size
+            end = min(start + self.page_size, self.num_results)
+            while len(self._served) < end:
+                self._extend()
+
+            positions = np.array(self._served[start:end], dtype=np.int64)
+            indices = self.candidates[positions]
+            sims = np.array(self._served_sims[start:end])
+            if not self.localize:
+                return indices, sims, None
+            bboxes = _map_bboxes(self.search_model, self._bboxes[positions],
+                                 indices)
+            return indices, sims, bboxes
+
+    def _extend(self):
+        """Localizes the next page of candidates and serves the best page of
+        the localized candidates not served yet"""
+        start = self._num_localized
+        end = min(start + self.page_size, len(self.candidates))
+        feature_idxs = self.candidates[start:end]
+        if len(feature_idxs) > 0:
+            reprs = None
+            if self.rerank:
+                reprs = self._reprs[start:end]
+            self._bboxes[start:end] = _localize_parallel(
+                self.search_model, self.query_features, feature_idxs,
+                self.image_shape, reprs=reprs)
+            if not self.rerank:
+                self._reprs[start:end] = \
+                    self.search_model.feature_store[feature_idxs]
+            self._num_localized = end
+            if end == len(self.candidates):
+                self.query_features = None
+
+        unserved = np.flatnonzero(~self._is_served[:end])
+        reprs = self._reprs[unserved]
+        idxs, sims = _query(self.query_repr, reprs)
+        if self.avg_qe:
+            idxs, sims = _average_query_exp(self.query_repr, reprs, idxs)
+
+        positions = unserved[idxs[:self.page_size]]
+        self._is_served[positions] = True
+        self._served.extend(positions)
+        self._served_sims.extend(sims[:self.page_size])
+
+
+def session_for_image(search_model, image, **kwargs):
+    """Creates a SearchSession for a query image
+
+    Args:
+    search_model: instance of the SearchModel class
+    image: array to search for in the shape of (height, width, 3)
+
+    See SearchSession for the keyword arguments.
+    """
+    query_features = compute_features(search_model.model, image)
+    return SearchSession(search_model, query_features, image.shape[:2],
+                         **kwargs)
+
+
+class SessionStore:
+    """Thread-safe store of search sessions, which are evicted after not
+    being accessed for ttl seconds, or least recently used first if more than
+    max_sessions are stored or their arrays take more than max_bytes
+    """
+    def __init__(self, ttl=DEFAULT_SESSION_TTL,
+                 max_sessions=DEFAULT_MAX_SESSIONS,
+                 max_bytes=DEFAULT_MAX_SESSION_MB * 2**20):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, session):
+        """Stores a session
+
+        Returns: the id of the session
+        """
+        session_id = uuid.uuid4().hex
+        with self._lock:
+            self._evict()
+            self._sessions[session_id] = session
+            num_bytes = sum(s.nbytes for s in self._sessions.values())
+            while len(self._sessions) > self.max_sessions \
+                or num_bytes > self.max_bytes:
+                _, evicted = self._sessions.popitem(last=False)
+                num_bytes -= evicted.nbytes
+        return session_id
+
+    def get(self, session_id):
+        """Returns the session of an id, or None if it does not exist or was
+        evicted"""
+        with self._lock:
+            self._evict()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.last_access = time.monotonic()
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def _evict(self):
+        deadline = time.monotonic() - self.ttl
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if session.last_access > deadline:
+                break
+            del self._sessions[session_id]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
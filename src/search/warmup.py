@@ -0,0 +1,155 @@
+"""Recording of served queries and warming of the search caches"""
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+# Size of the dummy query image used to compile the search code paths
+WARMUP_QUERY_SHAPE = (128, 128, 3)
+
+DEFAULT_MAX_LOG_BYTES = 64 * 2**20
+
+
+def rotated_path(path):
+    """Returns the path the full query log of path is moved to"""
+    return path + '.1'
+
+
+class QueryLog:
+    """Appends the results of served queries to a file, one JSON object per
+    line
+
+    Once the file reaches max_bytes, it is moved to rotated_path(path), 
+    replacing the log rotated before, and a new file is started. Processes 
+    forked after creating the log share it.
+    """
+    def __init__(self, path, max_bytes=DEFAULT_MAX_LOG_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def record(self, feature_idxs):
+        """Records the feature indices a query returned"""
+        entry = {
+            'time': time.time(),
+            'results': [int(idx) for idx in feature_idxs]
+        }
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            if os.fstat(self._file.fileno()).st_size >= self.max_bytes:
+                self._rotate()
+
+    def _rotate(self):
+        # Another process sharing the log may have rotated it already
+        try:
+            current = os.stat(self.path).st_ino == \
+                os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            current = False
+        self._file.close()
+        if current:
+            os.replace(self.path, rotated_path(self.path))
+        self._file = open(self.path, 'a')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _read_log_file(path, results):
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                idxs = entry['results']
+            except (ValueError, TypeError, KeyError):
+                continue  # Skip malformed lines, e.g. a truncated last line
+            if isinstance(idxs, list) and all(isinstance(idx, int) 
+                                              for idx in idxs):
+                results.append(idxs)
+
+
+def read_query_log(path):
+    """Reads a query log, including the log rotated before if it exists
+
+    Lines which can not be parsed are skipped.
+
+    Returns: list with the list of result indices of each logged query, in
+        the order in which the queries were served
+    """
+    results = []
+    if os.path.exists(rotated_path(path)):
+        _read_log_file(rotated_path(path), results)
+    _read_log_file(path, results)
+    return results
+
+
+def rank_by_frequency(query_results):
+    """Ranks feature indices by how often they were returned by queries
+
+    Args:
+    query_results: list of lists of result indices, as returned by
+        read_query_log
+
+    Returns: list of feature indices sorted by decreasing hit frequency
+    """
+    counts = Counter(idx for results in query_results for idx in results)
+    return [idx for idx, _ in counts.most_common()]
+
+
+def preload_features(search_model, feature_idxs):
+    """Loads feature maps into the feature cache until its budget is used up
+
+    Args:
+    search_model: instance of the SearchModel class
+    feature_idxs: indices of the feature maps to load, most important first.
+        Indices not in the feature store, e.g. logged before the features 
+        were extracted again, are skipped.
+
+    Returns: number of loaded feature maps
+    """
+    cache = search_model.feature_cache
+    num_features = len(search_model.feature_store)
+    num_loaded = 0
+    for feature_idx in feature_idxs:
+        if not 0 <= feature_idx < num_features:
+            continue
+        features = search_model.get_features(feature_idx)
+        num_loaded += 1
+        # Stop if the next map, assuming a similar size, would evict the 
+        # more important ones loaded before
+        if cache.stats['bytes'] + features.nbytes > cache.max_bytes:
+            break
+    return num_loaded
+
+
+def warmup_search(search_model):
+    """Runs a search on a dummy query, which initializes the model and
+    compiles the numba localization kernels before the first real query"""
+    from src.search.search import search
+
+    rng = np.random.RandomState(0)
+    query = rng.uniform(0, 255, WARMUP_QUERY_SHAPE).astype(np.float32)
+    search(search_model, query, top_n=1, localize_n=1)
+
+
+def warmup(search_model, query_log_path=None):
+    """Warms up a search model before it serves queries
+
+    Compiles the search code paths and, if a query log is given, preloads
+    the feature maps most frequently returned by the logged queries.
+
+    Returns: number of preloaded feature maps
+    """
+    warmup_search(search_model)
+
+    if query_log_path is None:
+        return 0
+    feature_idxs = rank_by_frequency(read_query_log(query_log_path))
+    return preload_features(search_model, feature_idxs)
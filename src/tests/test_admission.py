@@ -0,0 +1,64 @@
+import threading
+import time
+import unittest
+
+from src.admission import AdmissionController, OverloadedError
+
+class TestAdmission(unittest.TestCase):
+    def wait_queued(self, controller, num_queued):
+        while controller.stats['queued'] < num_queued:
+            time.sleep(0.001)
+
+    def test_admission(self):
+        controller = AdmissionController(max_running=2, max_queued=0)
+        self.assertFalse(controller.acquire())
+        self.assertFalse(controller.acquire())
+        with self.assertRaises(OverloadedError) as cm:
+            controller.acquire()
+        self.assertEqual(cm.exception.retry_after, 1)
+
+        controller.release()
+        self.assertFalse(controller.acquire())
+        self.assertEqual(controller.stats['admitted'], 3)
+        self.assertEqual(controller.stats['rejected'], 1)
+
+    def test_queue(self):
+        controller = AdmissionController(max_running=1, max_queued=2,
+                                         degrade_depth=1)
+        controller.acquire()
+
+        degraded = []
+        def run():
+            degraded.append(controller.acquire())
+            controller.release()
+
+        threads = [threading.Thread(target=run) for _ in range(2)]
+        threads[0].start()
+        self.wait_queued(controller, 1)
+        threads[1].start()
+        self.wait_queued(controller, 2)
+
+        # Queue is full
+        with self.assertRaises(OverloadedError):
+            controller.acquire()
+
+        controller.release()
+        for thread in threads:
+            thread.join()
+
+        # The request arriving at a queue of length 1 is degraded
+        self.assertEqual(sorted(degraded), [False, True])
+        self.assertEqual(controller.stats['running'], 0)
+        self.assertEqual(controller.stats['degraded'], 1)
+
+    def test_wait_timeout(self):
+        controller = AdmissionController(max_running=1, max_queued=1,
+                                         max_wait=0.01)
+        controller.acquire()
+        with self.assertRaises(OverloadedError):
+            controller.acquire()
+        self.assertEqual(controller.stats['queued'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
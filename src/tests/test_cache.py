@@ -0,0 +1,86 @@
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from src.search.cache import FeatureCache
+
+class TestFeatureCache(unittest.TestCase):
+    def setUp(self):
+        self.loads = []
+
+    def load(self, key):
+        self.loads.append(key)
+        return np.full(10, key, dtype=np.float32)  # 40 bytes
+
+    def test_hits_and_misses(self):
+        cache = FeatureCache(self.load, max_bytes=1000)
+        self.assertEqual(cache.get(1)[0], 1)
+        self.assertEqual(cache.get(1)[0], 1)
+        self.assertEqual(cache.get(2)[0], 2)
+        self.assertEqual(self.loads, [1, 2])
+        stats = cache.stats
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['bytes'], 80)
+
+    def test_load_fn(self):
+        cache = FeatureCache(None, max_bytes=1000)
+        self.assertEqual(cache.get(1, self.load)[0], 1)
+        self.assertEqual(cache.get(1)[0], 1)
+        self.assertEqual(self.loads, [1])
+
+    def test_read_only(self):
+        cache = FeatureCache(self.load, max_bytes=1000)
+        with self.assertRaises(ValueError):
+            cache.get(1)[0] = 0
+
+    def test_eviction(self):
+        cache = FeatureCache(self.load, max_bytes=100)
+        cache.get(1)
+        cache.get(2)
+        cache.get(1)  # Makes 2 the least recently used entry
+        cache.get(3)
+        self.assertIn(1, cache)
+        self.assertNotIn(2, cache)
+        self.assertIn(3, cache)
+        self.assertEqual(cache.stats['evictions'], 1)
+        self.assertEqual(cache.stats['bytes'], 80)
+
+    def test_too_large(self):
+        cache = FeatureCache(self.load, max_bytes=10)
+        self.assertEqual(cache.get(1)[0], 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_load_error(self):
+        def load(key):
+            raise IOError('Missing file')
+        cache = FeatureCache(load, max_bytes=100)
+        with self.assertRaises(IOError):
+            cache.get(1)
+        self.assertEqual(len(cache), 0)
+
+    def test_single_flight(self):
+        def load(key):
+            time.sleep(0.1)
+            return self.load(key)
+        cache = FeatureCache(load, max_bytes=1000)
+
+        results = []
+        def f():
+            results.append(cache.get(1))
+        threads = [threading.Thread(target=f) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.loads, [1])
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(r is results[0] for r in results))
+
+
+if __name__ == '__main__':
+    unittest.main()
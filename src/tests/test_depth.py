@@ -0,0 +1,57 @@
+import unittest
+
+import numpy as np
+
+from src.search.depth import AdaptiveDepth
+
+class TestDepth(unittest.TestCase):
+    def test_bounds(self):
+        policy = AdaptiveDepth(min_n=2, max_n=4, margin=None, gap=None)
+        self.assertEqual(policy(np.linspace(1, 0, 10)), 4)
+        self.assertEqual(policy(np.linspace(1, 0, 3)), 3)
+        self.assertEqual(policy(np.linspace(1, 0, 1)), 1)
+
+    def test_margin(self):
+        policy = AdaptiveDepth(min_n=2, max_n=10, margin=0.25, gap=None)
+        sims = np.array([0.9, 0.8, 0.7, 0.6, 0.5, 0.4])
+        self.assertEqual(policy(sims), 3)
+
+        # Never below min_n
+        self.assertEqual(policy(np.array([0.9, 0.1, 0.05, 0.0])), 2)
+
+    def test_gap(self):
+        policy = AdaptiveDepth(min_n=2, max_n=10, margin=None, gap=0.1)
+        sims = np.array([0.9, 0.88, 0.86, 0.6, 0.59, 0.58, 0.4])
+        # Cut at the largest gap, even if later gaps are wide as well
+        self.assertEqual(policy(sims), 3)
+
+        # Flat rankings are localized up to max_n
+        self.assertEqual(policy(np.linspace(0.9, 0.8, 20)), 10)
+
+        # Gaps before min_n are not considered
+        policy = AdaptiveDepth(min_n=4, max_n=10, margin=None, gap=0.1)
+        self.assertEqual(policy(sims), 6)
+
+    def test_stats(self):
+        policy = AdaptiveDepth(min_n=2, max_n=4, margin=None, gap=0.1)
+        policy(np.array([0.9, 0.8, 0.5, 0.45, 0.4]))
+        policy(np.linspace(1, 0.9, 10))
+        self.assertEqual(policy.stats, {'queries': 2, 'localized': 6,
+                                        'candidates': 8})
+
+    def test_query_candidates(self):
+        from src.search.search import _query_candidates
+        feature_store = np.eye(6)
+        query = np.array([[1.0, 0.9, 0.85, 0.2, 0.1, 0.0]])
+        policy = AdaptiveDepth(min_n=1, max_n=5, margin=None, gap=0.3)
+        indices, sims = _query_candidates(query, feature_store, True, policy)
+        self.assertEqual(list(indices), [0, 1, 2])
+
+        indices, sims = _query_candidates(query, feature_store, True, 2)
+        self.assertEqual(list(indices), [0, 1])
+        indices, sims = _query_candidates(query, feature_store, False, 2)
+        self.assertEqual(len(indices), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -25,6 +25,89 @@ class TestExtract(unittest.TestCase):
         expected = np.array([9.63, 9.13, 9.61, 8.78])
         self.assertEqual(_compute_mac(features), expected)
 
+        mac = _compute_mac(features.astype(np.float16))
+        self.assertEqual(mac.dtype, np.float32)
+        self.assertEqual(mac, expected.astype(np.float16).astype(np.float32))
+
+    def test_r_macs(self):
+        from src.features.extract import compute_r_macs
+        from src.util import normalize
+
+        def reference_r_macs(features, scales=(1, 4), overlap=0.4):
+            """Straightforward computation looping over all regions"""
+            def starts(length, size):
+                start = 0
+                while start < length:
+                    yield start
+                    if start + size == length:
+                        break
+                    start = round(start + (1 - overlap) * (start + size))
+
+            height, width = features.shape[0], features.shape[1]
+            r_macs = []
+            for scale in range(scales[0], scales[1]+1):
+                size = max(int(2 * min(height, width) / (scale + 1)), 1)
+                for row in starts(height, size):
+                    for col in starts(width, size):
+                        region = features[row:row+size, col:col+size]
+                        r_mac = np.amax(region, axis=(0, 1))
+                        r_macs.append(normalize(r_mac))
+                if size == 1:
+                    break
+            return np.vstack(r_macs)
+
+        rng = np.random.RandomState(1337)
+        for shape in [(1, 1, 3), (2, 5, 4), (7, 7, 2), (40, 30, 8), 
+                      (31, 62, 5), (13, 50, 3)]:
+            features = np.maximum(rng.randn(*shape), 0.0)
+            r_macs = compute_r_macs(features)
+            expected = reference_r_macs(features)
+            self.assertEqual(r_macs.shape, expected.shape)
+            np.testing.assert_allclose(r_macs, expected, rtol=1e-12)
+
+    def test_representation(self):
+        from sklearn.decomposition import PCA
+        from src.features.extract import compute_r_macs, compute_representation
+        from src.features.whitening import PCAWhitening
+        from src.util import normalize
+
+        rng = np.random.RandomState(1337)
+        features = np.maximum(rng.randn(20, 15, 8), 0.0)
+        pca = PCA(n_components=8).fit(rng.randn(100, 8))
+
+        expected = np.zeros((1, 8))
+        for r_mac in compute_r_macs(features):
+            expected += normalize(pca.transform(r_mac[np.newaxis]))
+        expected = normalize(expected)
+
+        representation = compute_representation(features, 
+                                                PCAWhitening.from_pca(pca))
+        self.assertEqual(representation.shape, (1, 8))
+        np.testing.assert_allclose(representation, expected, rtol=1e-10)
+
+    def test_whitening(self):
+        import tempfile
+        from sklearn.decomposition import PCA
+        from src.features.whitening import PCAWhitening
+
+        rng = np.random.RandomState(1337)
+        data = rng.randn(100, 8)
+        x = rng.randn(10, 8)
+        for whiten in [False, True]:
+            pca = PCA(n_components=6, whiten=whiten).fit(data)
+            whitening = PCAWhitening.from_pca(pca)
+            self.assertEqual(whitening.output_size, 6)
+            np.testing.assert_allclose(whitening.transform(x), 
+                                       pca.transform(x), atol=1e-12)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = tmp_dir + '/test.pca'
+            self.assertFalse(PCAWhitening.exists(path))
+            whitening.save(path)
+            self.assertTrue(PCAWhitening.exists(path))
+            loaded = PCAWhitening.load(path)
+            self.assertEqual(loaded.transform(x), whitening.transform(x))
+
 
 if __name__ == '__main__':
     unittest.main()
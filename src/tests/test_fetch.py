@@ -0,0 +1,136 @@
+import threading
+import time
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+class FileHandler(BaseHTTPRequestHandler):
+    """Serves FILES over persistent connections, with /slow waiting for the 
+    release event of the server before responding, and /drip sending its 
+    body one byte at a time"""
+    FILES = {
+        '/small': b'x' * 1000,
+        '/large': b'y' * 300000,
+        '/slow': b'z' * 10
+    }
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.num_connections += 1
+
+    def do_GET(self):
+        if self.path == '/drip':
+            self.send_response(200)
+            self.send_header('Content-Length', '1000')
+            self.end_headers()
+            try:
+                for _ in range(1000):
+                    self.wfile.write(b'd')
+                    self.wfile.flush()
+                    time.sleep(0.05)
+            except OSError:
+                pass
+            return
+        if self.path == '/slow':
+            self.server.release.wait()
+        if self.path not in self.FILES:
+            self.send_error(404)
+            return
+        data = self.FILES[self.path]
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestFetch(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadedHTTPServer(('localhost', 0), FileHandler)
+        self.server.release = threading.Event()
+        self.server.lock = threading.Lock()
+        self.server.num_connections = 0
+        self.thread = threading.Thread(target=self.server.serve_forever, 
+                                       daemon=True)
+        self.thread.start()
+        self.url = 'http://localhost:{}'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch(self):
+        from src.fetch import ImageFetcher
+        fetcher = ImageFetcher(max_size=200000)
+        file = fetcher.fetch(self.url + '/small')
+        self.assertEqual(file.read(), FileHandler.FILES['/small'])
+        # Reuses the pooled connection
+        file = fetcher.fetch(self.url + '/small')
+        self.assertEqual(file.read(), FileHandler.FILES['/small'])
+        self.assertEqual(self.server.num_connections, 1)
+
+        self.assertIsNone(fetcher.fetch(self.url + '/large'))
+        self.assertIsNone(fetcher.fetch(self.url + '/missing'))
+        self.assertIsNone(fetcher.fetch('http://localhost:1/unreachable'))
+
+    def test_max_time(self):
+        from src.fetch import ImageFetcher
+        fetcher = ImageFetcher(max_concurrent=1, timeout=1, max_time=0.5)
+        # Each read of a chunk would wait for the whole body to trickle in
+        start_time = time.time()
+        self.assertIsNone(fetcher.fetch(self.url + '/drip'))
+        self.assertLess(time.time() - start_time, 1.5)
+
+        # The download slot is free again
+        file = fetcher.fetch(self.url + '/small')
+        self.assertEqual(file.read(), FileHandler.FILES['/small'])
+
+    def test_shut_down(self):
+        import requests
+        from urllib3.exceptions import HTTPError
+        from src.fetch import _shut_down
+        with requests.Session() as session:
+            r = session.get(self.url + '/drip', stream=True, timeout=5)
+            self.assertIsNotNone(getattr(r.raw.connection, 'sock', None))
+            # Aborts a read waiting for the whole body of 50 seconds
+            timer = threading.Timer(0.2, _shut_down, [r])
+            timer.start()
+            start_time = time.time()
+            try:
+                r.raw.read(1000)
+            except (HTTPError, OSError):
+                pass
+            timer.join()
+            r.close()
+        self.assertLess(time.time() - start_time, 2)
+
+    def test_concurrency_limit(self):
+        from src.fetch import ImageFetcher, FetchCapacityError
+        fetcher = ImageFetcher(max_concurrent=1, wait_time=0.1)
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(fetcher.fetch(self.url + '/slow')))
+        thread.start()
+        time.sleep(0.2)  # Let the slow download take the only slot
+
+        with self.assertRaises(FetchCapacityError):
+            fetcher.fetch(self.url + '/small')
+
+        self.server.release.set()
+        thread.join()
+        self.assertEqual(results[0].read(), FileHandler.FILES['/slow'])
+        file = fetcher.fetch(self.url + '/small')
+        self.assertEqual(file.read(), FileHandler.FILES['/small'])
+
+
+if __name__ == '__main__':
+    unittest.main()
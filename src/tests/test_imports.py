@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+import unittest
+
+proj_dir = os.path.abspath(os.path.split(os.path.realpath(__file__))[0]
+                           + '/../..')
+
+# Modules which must be importable without pulling in heavy dependencies, 
+# such that commandline tools and servers start fast
+LIGHT_MODULES = ['src.util', 'src.database', 'src.features', 'src.models', 
+                 'src.search']
+
+# Dependencies which must only be imported lazily when they are needed
+HEAVY_MODULES = ['keras', 'tensorflow', 'theano', 'sklearn', 'numba']
+
+# Maximum time in seconds importing all light modules may take
+IMPORT_TIME_BUDGET = 1.0
+
+CHECK_SCRIPT = '''
+import sys
+from timeit import default_timer as timer
+start_time = timer()
+import {modules}
+print(timer() - start_time)
+print(','.join(m for m in {heavy} if m in sys.modules))
+'''
+
+class TestImports(unittest.TestCase):
+    def test_import_time(self):
+        script = CHECK_SCRIPT.format(modules=', '.join(LIGHT_MODULES),
+                                     heavy=HEAVY_MODULES)
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         cwd=proj_dir)
+        import_time, heavy_modules = output.decode().split('\n')[:2]
+
+        self.assertEqual(heavy_modules, '', 
+                         'Heavy modules imported: {}'.format(heavy_modules))
+        self.assertLess(float(import_time), IMPORT_TIME_BUDGET)
+
+
+if __name__ == '__main__':
+    unittest.main()
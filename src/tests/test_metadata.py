@@ -0,0 +1,54 @@
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from src.tests.util import numpy_array_equals
+
+class TestMetadata(unittest.TestCase):
+    def setUp(self):
+        eq_fn = lambda a, e, msg: numpy_array_equals(self, a, e, msg)
+        self.addTypeEqualityFunc(np.ndarray, eq_fn)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.legacy_metadata = {
+            'model': 'VGG16',
+            '0': {'image': 'images/a.png', 'width': 10, 'height': 20},
+            '1': {'image': 'images/bä.png', 'width': 30, 'height': 40},
+            '2': {'image': 'c.jpg', 'width': 50, 'height': 60}
+        }
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def check_metadata(self, metadata):
+        self.assertEqual(len(metadata), 3)
+        self.assertEqual(metadata.get('model'), 'VGG16')
+        self.assertEqual(metadata.get('feature_format', 'dense'), 'dense')
+        for idx in range(3):
+            self.assertEqual(metadata[idx], self.legacy_metadata[str(idx)])
+        self.assertEqual(metadata[np.int64(1)]['image'], 'images/bä.png')
+        self.assertEqual(metadata.image(2), 'c.jpg')
+        self.assertEqual(metadata.column('width')[np.array([2, 0])],
+                         np.array([50, 10]))
+
+    def test_from_dict(self):
+        from src.features.metadata import FeatureMetadata
+        self.check_metadata(FeatureMetadata.from_dict(self.legacy_metadata))
+
+    def test_save_load(self):
+        from src.features.metadata import FeatureMetadata
+        path = os.path.join(self.tmp_dir.name, 'test.meta')
+        with open(path, 'w') as f:
+            json.dump(self.legacy_metadata, f)
+        metadata = FeatureMetadata.load(path)
+        self.check_metadata(metadata)
+
+        metadata.save(path)  # Replaces the legacy JSON file
+        self.assertTrue(os.path.isdir(path))
+        self.check_metadata(FeatureMetadata.load(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import logging
+import os
+import signal
+import socket
+import time
+import unittest
+import urllib.request
+
+from flask import Flask
+
+from src.prefork import serve_preforked, RESTART_DELAY
+
+
+def child_pids(pid):
+    """Returns the pids of the living child processes of a process"""
+    pids = set()
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # Fields after the parenthesized command name: state, ppid, ...
+        state, ppid = stat[stat.rfind(')')+2:].split()[:2]
+        if int(ppid) == pid and state != 'Z':
+            pids.add(int(name))
+    return pids
+
+
+def wait_for(condition, timeout=10):
+    """Polls condition until it is true, returning False after timeout"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+class TestPrefork(unittest.TestCase):
+    def setUp(self):
+        sock = socket.socket()
+        sock.bind(('localhost', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        app = Flask(__name__)
+        initialized = []
+
+        @app.route('/')
+        def index():
+            return '{} {}'.format(os.getpid(), len(initialized))
+
+        self.pid = os.fork()
+        if self.pid == 0:
+            exit_code = 0
+            try:
+                serve_preforked(app, 'localhost', self.port, num_workers=2,
+                                init_worker=lambda: initialized.append(True))
+            except BaseException:
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+    def tearDown(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+            os.waitpid(self.pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+
+    def request(self):
+        url = 'http://localhost:{}/'.format(self.port)
+        with urllib.request.urlopen(url, timeout=5) as response:
+            pid, initialized = response.read().decode().split()
+        return int(pid), int(initialized)
+
+    def wait_for_workers(self, num_workers):
+        self.assertTrue(wait_for(
+            lambda: len(child_pids(self.pid)) == num_workers))
+        return child_pids(self.pid)
+
+    def test_serve_preforked(self):
+        workers = self.wait_for_workers(2)
+
+        def served():
+            try:
+                return self.request()
+            except OSError:
+                return None
+        self.assertTrue(wait_for(lambda: served() is not None))
+        for _ in range(4):
+            pid, initialized = self.request()
+            self.assertIn(pid, workers)
+            self.assertEqual(initialized, 1)
+
+        # Killed workers are replaced
+        killed = workers.pop()
+        os.kill(killed, signal.SIGKILL)
+        self.assertTrue(wait_for(lambda: killed not in child_pids(self.pid)))
+        self.assertTrue(wait_for(lambda: len(child_pids(self.pid)) == 2,
+                                 timeout=RESTART_DELAY + 10))
+        new_workers = child_pids(self.pid)
+        self.assertNotIn(killed, new_workers)
+        self.assertTrue(workers < new_workers)
+        for _ in range(4):
+            pid, _ = self.request()
+            self.assertIn(pid, new_workers)
+
+        # Terminating the parent stops all workers
+        os.kill(self.pid, signal.SIGTERM)
+        _, status = os.waitpid(self.pid, 0)
+        self.assertTrue(os.WIFEXITED(status))
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+
+        def stopped(pid):
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return True
+            return False
+        for pid in new_workers:
+            self.assertTrue(wait_for(lambda: stopped(pid)))
+        with self.assertRaises(OSError):
+            self.request()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import threading
+import unittest
+
+import numpy as np
+
+from src.tests.util import (numpy_array_equals, FeatureModel, 
+                            random_features)
+
+class TestSearch(unittest.TestCase):
+    def setUp(self):
+        eq_fn = lambda a, e, msg: numpy_array_equals(self, a, e, msg)
+        self.addTypeEqualityFunc(np.ndarray, eq_fn)
+        # Two images of shape (height=100, width=200) and (50, 50)
+        features = random_features([(10, 20, 2), (5, 5, 2)])
+        self.search_model = FeatureModel(features, [(100, 200), (50, 50)])
+
+    def test_map_bboxes(self):
+        from src.search.search import _map_bboxes
+        bboxes = np.array([[1, 2, 3, 4], [0, 0, 4, 4]])
+        mapped = _map_bboxes(self.search_model, bboxes, [0, 1])
+        self.assertEqual(mapped, [(10, 20, 30, 40), (0, 0, 40, 40)])
+        self.assertEqual(_map_bboxes(self.search_model, 
+                                     np.empty((0, 4), dtype=int), []), [])
+
+    def test_crop_features(self):
+        from src.search.search import crop_features
+        features = self.search_model.features[0]
+        cropped, shape = crop_features(features, (100, 200), (15, 20, 40, 100))
+        self.assertEqual(shape, (80, 25))
+        self.assertEqual(cropped, features[2:10, 1:4])
+
+        # Regions are clipped to the image
+        features = self.search_model.features[1]
+        cropped, shape = crop_features(features, (50, 50), (-10, 0, 100, 5))
+        self.assertEqual(shape, (5, 50))
+        self.assertEqual(cropped, features[0:1, 0:5])
+
+        with self.assertRaises(ValueError):
+            crop_features(features, (50, 50), (60, 0, 70, 10))
+
+    def test_search_stages(self):
+        from src.search.search import _search_stages, _search_features
+        query = self.search_model.features[0][2:6, 4:12]
+        args = (self.search_model, query, (40, 80), 0, True, 2, True, False)
+        stages = list(_search_stages(*args))
+        self.assertEqual([stage for stage, _ in stages], 
+                         ['ranking', 'localization', 'localization', 
+                          'result'])
+
+        ranked_idxs, ranked_sims = stages[0][1]
+        self.assertEqual(len(ranked_idxs), 2)
+
+        indices, sims, bboxes = stages[-1][1]
+        expected = _search_features(*args)
+        self.assertEqual(indices, expected[0])
+        self.assertEqual(sims, expected[1])
+        self.assertEqual(bboxes, expected[2])
+
+        # Each localization carries the final bounding box and reranked score
+        final = {idx: (sim, bbox) for idx, sim, bbox in zip(indices, sims, 
+                                                             bboxes)}
+        for _, (idx, bbox, sim) in stages[1:3]:
+            self.assertEqual(bbox, final[idx][1])
+            self.assertAlmostEqual(sim, final[idx][0])
+
+    def test_search_stages_close(self):
+        """Closing the stages early stops the localization"""
+        from concurrent.futures import Future
+        from src.search.search import _search_stages
+        search_model = FeatureModel(random_features([(6, 6, 8)] * 10))
+        futures = []
+
+        # Only the first feature map finishes loading
+        def prefetch_features(feature_idxs):
+            futures.extend(Future() for _ in feature_idxs)
+            futures[0].set_result(search_model.get_features(feature_idxs[0]))
+            return futures
+        search_model.prefetch_features = prefetch_features
+
+        num_threads = threading.active_count()
+        stages = _search_stages(search_model, search_model.features[0], 
+                                (60, 60), 0, True, 10, True, False)
+        self.assertEqual(next(stages)[0], 'ranking')
+        self.assertEqual(next(stages)[0], 'localization')
+        stages.close()
+        self.assertTrue(all(future.cancelled() for future in futures[1:]))
+        self.assertEqual(threading.active_count(), num_threads)
+
+    def test_search_without_rerank(self):
+        """Searches as in the degraded mode of the web backend, which 
+        disables localization or localizes fewer results"""
+        from src.features import compute_representation
+        from src.search.search import search_feature_region
+        search_model = FeatureModel(random_features([(6, 6, 8)] * 10))
+        features = search_model.features[3]
+        query_repr = compute_representation(features[1:5, 1:5])
+        sims = search_model.feature_store.dot(query_repr.ravel())
+        expected = np.argsort(-sims)
+
+        indices, scores, bboxes = search_feature_region(
+            search_model, features, (60, 60), (10, 10, 50, 50), top_n=5, 
+            localize=False, rerank=False, avg_qe=False)
+        self.assertEqual(indices, expected[:5])
+        self.assertEqual(scores[:5], sims[expected[:5]])
+        self.assertIsNone(bboxes)
+
+        indices, _, bboxes = search_feature_region(
+            search_model, features, (60, 60), (10, 10, 50, 50), top_n=3, 
+            localize=True, localize_n=4, rerank=False, avg_qe=False)
+        self.assertEqual(indices, expected[:3])
+        self.assertEqual(len(bboxes), 3)
+
+        # Query expansion with the five best results
+        avg_repr = np.average(np.vstack((
+            search_model.feature_store[expected[:5]], query_repr)), axis=0)
+        expected_qe = np.argsort(-search_model.feature_store.dot(avg_repr))
+        indices, _, _ = search_feature_region(
+            search_model, features, (60, 60), (10, 10, 50, 50), top_n=5, 
+            localize=False, rerank=False, avg_qe=True)
+        self.assertEqual(indices, expected_qe[:5])
+
+        # With localization, the expansion only reranks the localized results
+        indices, _, _ = search_feature_region(
+            search_model, features, (60, 60), (10, 10, 50, 50), top_n=6, 
+            localize=True, localize_n=6, rerank=False, avg_qe=True)
+        self.assertEqual(sorted(indices), sorted(expected[:6]))
+        self.assertEqual(indices, np.array([idx for idx in expected_qe 
+                                            if idx in expected[:6]]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from src.tests.util import (numpy_array_equals, FeatureModel, 
+                            random_features)
+
+class DoublingModel:
+    output_shape = (None, None, None, 3)
+
+    def predict(self, data):
+        if np.any(data < 0):
+            raise ValueError('Negative input')
+        return np.expand_dims(data * 2, axis=0)
+
+
+class ModelStub(FeatureModel):
+    """Minimal stand-in for SearchModel with a model and the feature maps 
+    of four images, whose metadata is saved to features_path"""
+    def __init__(self, features_path):
+        FeatureModel.__init__(self, random_features([(8, 8, 3)] * 4))
+        self.features_path = features_path
+        self.model = DoublingModel()
+        self.feature_metadata.save(os.path.join(features_path, 
+                                                'features.meta'))
+
+    def query_database(self, image):
+        return {'external_url': 'http://{}'.format(image)}
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        eq_fn = lambda a, e, msg: numpy_array_equals(self, a, e, msg)
+        self.addTypeEqualityFunc(np.ndarray, eq_fn)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_shared_array(self):
+        from src.search.server import _pack, _unpack, SharedArray
+        small = np.arange(10)
+        large = np.arange(100000, dtype=np.float32).reshape(100, 1000)
+        packed = _pack((small, [large], {'a': 1}))
+        self.assertIs(packed[0], small)
+        self.assertIsInstance(packed[1][0], SharedArray)
+        self.assertTrue(os.path.exists(packed[1][0].path))
+
+        unpacked = _unpack(packed)
+        self.assertEqual(np.asarray(unpacked[1][0]), large)
+        self.assertEqual(unpacked[2], {'a': 1})
+        self.assertFalse(os.path.exists(packed[1][0].path))
+
+    def test_shared_array_path(self):
+        from src.search.server import SharedArray
+        path = os.path.join(self.tmp_dir.name, 'search_a.npy')
+        np.save(path, np.arange(10))
+
+        # Peers can not make the receiver load or remove other files
+        shared = SharedArray(np.arange(10))
+        os.remove(shared.path)
+        shared.path = path
+        with self.assertRaises(ValueError):
+            shared.load()
+        shared.discard()
+        self.assertTrue(os.path.exists(path))
+
+    def start_server(self, search_model):
+        from src.search.server import SearchServer, authkey_path
+        # The listener removes its socket when the process exits
+        address = os.path.join(tempfile.gettempdir(), 
+                               'test_search_{}.sock'.format(os.getpid()))
+        self.addCleanup(lambda: os.path.exists(authkey_path(address)) 
+                        and os.remove(authkey_path(address)))
+        server = SearchServer(search_model, address)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        for _ in range(50):  # Wait for the server to listen
+            if os.path.exists(address):
+                break
+            time.sleep(0.05)
+        return address
+
+    def test_client(self):
+        from multiprocessing import AuthenticationError
+        from src.search import (search, search_by_region, 
+                                search_feature_region, search_regions)
+        from src.search.server import SearchClient, authkey_path
+        features_path = os.path.join(self.tmp_dir.name, 'features')
+        os.mkdir(features_path)
+        # Clients find the metadata even if the server got a relative path
+        search_model = ModelStub(os.path.relpath(features_path))
+        address = self.start_server(search_model)
+        self.assertEqual(os.stat(address).st_mode & 0o777, 0o600)
+        self.assertEqual(os.stat(authkey_path(address)).st_mode & 0o777, 
+                         0o600)
+
+        client = SearchClient(address)
+        self.assertEqual(client._call('info')['features_path'], 
+                         features_path)
+        self.assertEqual(client.model.output_shape, (None, None, None, 3))
+        self.assertEqual(client.get_metadata(0)['image'], '0.png')
+        self.assertEqual(client.query_database('a.png'),
+                         {'external_url': 'http://a.png'})
+
+        data = np.ones((200, 100, 3), dtype=np.float32)
+        output = client.model.predict(data)
+        self.assertEqual(np.asarray(output), 
+                         np.full((1, 200, 100, 3), 2.0, dtype=np.float32))
+        with self.assertRaises(ValueError):
+            client.model.predict(-data)
+
+        # Searches run on the server give the results of local searches
+        features = search_model.features[1]
+        query = features / 2
+        kwargs = {'top_n': 3, 'localize_n': 3}
+        self.assertSearchEqual(client.search(query, **kwargs),
+                               search(search_model, query, **kwargs))
+        self.assertSearchEqual(
+            client.search_by_region(2, (0, 0, 60, 40), **kwargs),
+            search_by_region(search_model, 2, (0, 0, 60, 40), **kwargs))
+        self.assertSearchEqual(
+            client.search_feature_region(features, (80, 80), (10, 10, 50, 50),
+                                         **kwargs),
+            search_feature_region(search_model, features, (80, 80), 
+                                  (10, 10, 50, 50), **kwargs))
+        with self.assertRaises(ValueError):
+            client.search_feature_region(features, (80, 80), 
+                                         (100, 100, 120, 120))
+
+        bounding_boxes = [(0, 0, 4, 6), (2, 2, 8, 8)]
+        actual = client.search_regions(query, bounding_boxes, **kwargs)
+        expected = search_regions(search_model, query, bounding_boxes, 
+                                  **kwargs)
+        self.assertEqual(len(actual), 2)
+        for actual_results, expected_results in zip(actual, expected):
+            self.assertSearchEqual(actual_results, expected_results)
+
+        with self.assertRaises(AuthenticationError):
+            SearchClient(address, authkey=b'wrong key')
+        # The server keeps serving after a failed authentication
+        self.assertEqual(client.query_database('b.png'),
+                         {'external_url': 'http://b.png'})
+
+    def assertSearchEqual(self, actual, expected):
+        self.assertEqual(np.asarray(actual[0]), expected[0])
+        self.assertEqual(np.asarray(actual[1]), expected[1])
+        self.assertEqual(actual[2], expected[2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import time
+import unittest
+
+import numpy as np
+
+from src.tests.util import (numpy_array_equals, FeatureModel, 
+                            random_features)
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        eq_fn = lambda a, e, msg: numpy_array_equals(self, a, e, msg)
+        self.addTypeEqualityFunc(np.ndarray, eq_fn)
+        # Six images of shape (height=80, width=80)
+        self.search_model = FeatureModel(random_features([(8, 8, 4)] * 6))
+        self.query = self.search_model.features[2][1:5, 2:6]
+
+    def test_single_page(self):
+        from src.search.search import _search_features
+        from src.search.session import SearchSession
+        session = SearchSession(self.search_model, self.query, (40, 40),
+                                page_size=6, localize_n=6)
+        indices, sims, bboxes = session.page(0)
+        expected = _search_features(self.search_model, self.query, (40, 40),
+                                    6, True, 6, True, True)
+        self.assertEqual(indices, expected[0])
+        self.assertEqual(sims, expected[1][:6])
+        self.assertEqual(bboxes, expected[2])
+
+    def test_pages(self):
+        from src.search.session import SearchSession
+        session = SearchSession(self.search_model, self.query, (40, 40),
+                                page_size=2, localize_n=5)
+        self.assertEqual(session.num_results, 5)
+        self.assertEqual(session.num_pages, 3)
+
+        first = session.page(0)
+        self.assertEqual(len(first[0]), 2)
+        self.assertEqual(session.num_localized, 2)
+        self.assertIsNotNone(session.query_features)
+
+        # Viewing a page localizes the pages before it
+        last = session.page(2)
+        self.assertEqual(len(last[0]), 1)
+        self.assertEqual(session.num_localized, 5)
+        self.assertEqual(len(session.page(3)[0]), 0)
+
+        # The query is not needed anymore after localizing all candidates
+        self.assertIsNone(session.query_features)
+
+        # Served pages do not change, and all candidates are served once
+        self.assertEqual(session.page(0)[0], first[0])
+        indices = np.concatenate([session.page(p)[0] for p in range(3)])
+        self.assertEqual(sorted(indices), sorted(session.candidates))
+
+    def test_without_localization(self):
+        from src.search.session import SearchSession
+        session = SearchSession(self.search_model, self.query, (40, 40),
+                                page_size=4, localize=False, rerank=False,
+                                avg_qe=False)
+        self.assertEqual(session.num_results, 6)
+        indices, sims, bboxes = session.page(1)
+        self.assertEqual(len(indices), 2)
+        self.assertIsNone(bboxes)
+        self.assertEqual(session.num_localized, 6)
+        self.assertIsNone(session.query_features)
+        self.assertEqual(session.nbytes, 6 * 3 * 8)
+
+    def test_session_store(self):
+        from src.search.session import SessionStore
+
+        class Session:
+            last_access = time.monotonic()
+            nbytes = 100
+
+        store = SessionStore(ttl=60, max_sessions=2)
+        ids = [store.add(Session()) for _ in range(3)]
+        self.assertEqual(len(store), 2)
+        self.assertIsNone(store.get(ids[0]))
+        session = store.get(ids[1])
+        self.assertIsNotNone(session)
+        self.assertIsNotNone(store.get(ids[2]))
+
+        # Sessions not accessed for ttl seconds are evicted
+        session.last_access -= 120
+        self.assertIsNone(store.get(ids[1]))
+        self.assertEqual(len(store), 1)
+
+        # Least recently used sessions are evicted above max_bytes
+        store = SessionStore(ttl=60, max_sessions=10, max_bytes=250)
+        ids = [store.add(Session()) for _ in range(2)]
+        store.get(ids[0])
+        ids.append(store.add(Session()))
+        self.assertEqual(len(store), 2)
+        self.assertIsNone(store.get(ids[1]))
+        self.assertIsNotNone(store.get(ids[0]))
+        self.assertIsNotNone(store.get(ids[2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
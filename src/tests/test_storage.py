@@ -0,0 +1,44 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from src.tests.util import numpy_array_equals
+
+class TestStorage(unittest.TestCase):
+    def setUp(self):
+        eq_fn = lambda a, e, msg: numpy_array_equals(self, a, e, msg)
+        self.addTypeEqualityFunc(np.ndarray, eq_fn)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(self.tmp_dir.name, 'features'))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_feature_file_path(self):
+        from src.features.storage import feature_file_path
+        path = feature_file_path('feats', 'images/a.png', 'sparse')
+        self.assertEqual(path, os.path.join('feats', 'features/', 'a.png.npz'))
+        with self.assertRaises(ValueError):
+            feature_file_path('feats', 'a.png', 'unknown')
+
+    def test_save_load(self):
+        from src.features.storage import (FEATURE_FORMATS, feature_file_path,
+                                          save_features, load_features,
+                                          load_feature_shape)
+        rng = np.random.RandomState(1337)
+        features = rng.rand(5, 7, 3).astype(np.float32)
+        features[features < 0.7] = 0.0
+        for feature_format in FEATURE_FORMATS:
+            path = feature_file_path(self.tmp_dir.name, 'image.png',
+                                     feature_format)
+            save_features(path, features)
+            loaded = load_features(path)
+            self.assertEqual(loaded.dtype, features.dtype)
+            self.assertEqual(loaded, features)
+            self.assertEqual(load_feature_shape(path), features.shape)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,6 +19,15 @@ class TestUtil(unittest.TestCase):
         expected = np.array([[0.0], [0.0], [0.0]])
         self.assertEqual(normalize(v), expected)
 
+    def test_clip_bounding_box(self):
+        from src.util import clip_bounding_box
+        self.assertEqual(clip_bounding_box((-5, 10, 30, 100), (50, 20)),
+                         (0, 10, 20, 50))
+        with self.assertRaises(ValueError):
+            clip_bounding_box((20, 0, 30, 10), (50, 20))
+        with self.assertRaises(ValueError):
+            clip_bounding_box((10, 10, 10, 20), (50, 20))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from src.tests.util import FeatureModel, random_features
+
+class TestWarmup(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_query_log(self):
+        from src.search.warmup import QueryLog, read_query_log
+        path = os.path.join(self.tmp_dir.name, 'queries.log')
+        query_log = QueryLog(path)
+        query_log.record(np.array([3, 1, 2]))
+        query_log.record([])
+        query_log.record([1])
+        self.assertEqual(read_query_log(path), [[3, 1, 2], [], [1]])
+
+        # Malformed lines, like the truncated last line of a crashed 
+        # server, are skipped
+        with open(path, 'a') as f:
+            f.write('{"results": [4]}\n[5]\n{"results": ["a"]}\n'
+                    '{"results": [6, ')
+        self.assertEqual(read_query_log(path), [[3, 1, 2], [], [1], [4]])
+        query_log.close()
+
+    def test_query_log_rotation(self):
+        from src.search.warmup import QueryLog, read_query_log, rotated_path
+        path = os.path.join(self.tmp_dir.name, 'queries.log')
+        query_log = QueryLog(path, max_bytes=100)
+        for idx in range(10):
+            query_log.record([idx])
+        query_log.close()
+        self.assertLess(os.path.getsize(path), 100)
+        self.assertLess(os.path.getsize(rotated_path(path)), 150)
+
+        # The most recent queries are read from both files
+        results = read_query_log(path)
+        self.assertEqual(results, [[idx] for idx in 
+                                   range(10 - len(results), 10)])
+
+    def test_rank_by_frequency(self):
+        from src.search.warmup import rank_by_frequency
+        ranking = rank_by_frequency([[3, 1, 2], [1, 2], [1]])
+        self.assertEqual(ranking, [1, 2, 3])
+
+    def test_preload_features(self):
+        from src.search.warmup import preload_features
+        # Feature maps of 40 bytes each
+        features = random_features([(2, 5, 1)] * 6)
+        search_model = FeatureModel(features, max_cache_bytes=100)
+        # Indices out of the feature store, e.g. from an old log, are skipped
+        num_loaded = preload_features(search_model, [5, 6, -1, 4, 3, 2])
+        self.assertEqual(num_loaded, 2)
+        self.assertIn(5, search_model.feature_cache)
+        self.assertIn(4, search_model.feature_cache)
+        self.assertEqual(search_model.feature_cache.stats['evictions'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
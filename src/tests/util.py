@@ -6,3 +6,63 @@ def numpy_array_equals(test, actual, expected, msg=None):
         np.testing.assert_array_equal(actual, expected)
     except AssertionError:
         raise test.failureException(msg)
+
+
+class FeatureModel:
+    """Minimal stand-in for SearchModel serving feature maps from memory"""
+    def __init__(self, features, image_sizes=None, max_cache_bytes=None):
+        """
+        Args:
+        features: list of feature maps of shape (height, width, channels)
+        image_sizes: list of the (height, width) of the images of the 
+            feature maps. By default, images are 10 times as large as their
+            feature maps.
+        max_cache_bytes: if given, feature maps are loaded through a 
+            FeatureCache of this size
+        """
+        from src.features import FeatureMetadata, compute_representation
+        from src.search.cache import FeatureCache
+        if image_sizes is None:
+            image_sizes = [(10 * f.shape[0], 10 * f.shape[1]) 
+                           for f in features]
+        entries = [{'image': '{}.png'.format(idx), 'height': height, 
+                    'width': width, 'feature_height': f.shape[0], 
+                    'feature_width': f.shape[1]}
+                   for idx, (f, (height, width)) in enumerate(
+                       zip(features, image_sizes))]
+        self.features = features
+        self.feature_metadata = FeatureMetadata.from_entries({}, entries)
+        self.pca = None
+        self.feature_store = np.concatenate([compute_representation(f)
+                                             for f in features])
+        self.feature_cache = None
+        if max_cache_bytes is not None:
+            self.feature_cache = FeatureCache(self.features.__getitem__, 
+                                              max_cache_bytes)
+
+    def get_metadata(self, feature_idx):
+        return self.feature_metadata[feature_idx]
+
+    def get_features(self, feature_idx):
+        if self.feature_cache is not None:
+            return self.feature_cache.get(feature_idx)
+        return self.features[feature_idx]
+
+    def prefetch_features(self, feature_idxs):
+        from concurrent.futures import Future
+        futures = []
+        for idx in feature_idxs:
+            future = Future()
+            future.set_result(self.get_features(idx))
+            futures.append(future)
+        return futures
+
+    def get_feature_shapes(self, feature_idxs):
+        shapes = [self.features[idx].shape[:2] for idx in feature_idxs]
+        return np.array(shapes, dtype=int).reshape(-1, 2)
+
+
+def random_features(shapes, seed=0):
+    """Returns random float32 feature maps of the given shapes"""
+    rng = np.random.RandomState(seed)
+    return [rng.rand(*shape).astype(np.float32) for shape in shapes]
@@ -1,5 +1,5 @@
 import numpy as np
-import keras.preprocessing.image as keras_image
+from PIL import Image
 
 def normalize(v):
     """L2 normalization of vector"""
@@ -8,7 +8,32 @@ def normalize(v):
         return v
     else:
         return v / norm
-    
+
+
+def normalize_rows(m):
+    """L2 normalization of each row of a matrix"""
+    norms = np.linalg.norm(m, axis=1, keepdims=True)
+    norms[norms == 0.0] = 1.0
+    return m / norms
+
+
+def clip_bounding_box(bounding_box, image_shape):
+    """Clips a bounding box to an image
+
+    Args:
+    bounding_box: Bounding box in the form of (left, upper, right+1, lower+1)
+    image_shape: shape of the image in the form of (height, width)
+
+    Returns: the clipped bounding box
+
+    Raises: ValueError if the bounding box does not overlap the image
+    """
+    height, width = image_shape
+    x1, y1, x2, y2 = np.clip(bounding_box, 0, [width, height, width, height])
+    if x1 >= x2 or y1 >= y2:
+        raise ValueError('Region of interest out of range')
+    return x1, y1, x2, y2
+
 
 def crop_image(image, bounding_box):
     """Crops a PIL image to a bounding box. 
@@ -20,13 +45,8 @@ def crop_image(image, bounding_box):
     """
     width, height = image.size
     if bounding_box is None:
-        x1, y1, x2, y2 = 0, 0, width, height
-    else:
-        x1, y1, x2, y2 = bounding_box
-    x1, y1, x2, y2 = np.clip([x1, y1, x2, y2], 0,
-                             [width, height, width, height])
-    if x1 >= x2 or y1 >= y2:
-        raise ValueError('Region of interest out of range')
+        bounding_box = 0, 0, width, height
+    x1, y1, x2, y2 = clip_bounding_box(bounding_box, (height, width))
 
     # PIL crop excludes x2/y2 coordinates from the crop
     return image.crop((x1, y1, x2, y2))
@@ -37,7 +57,9 @@ def convert_image(image):
     
     Returns: The image as a numpy array of the shape (height, width, channels)
     """
-    image = keras_image.img_to_array(image)
+    image = np.asarray(image, dtype=np.float32)
+    if image.ndim == 2:
+        image = np.expand_dims(image, axis=2)
     return image
 
 
@@ -46,5 +68,5 @@ def load_image(image_path):
 
     Returns: The image as a numpy array of the shape (height, width, channels)
     """
-    image = keras_image.load_img(image_path)
-    return convert_image(image)
+    with Image.open(image_path) as image:
+        return convert_image(image.convert('RGB'))
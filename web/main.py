@@ -4,23 +4,44 @@ import os
 import io
 import time
 import json
+import hashlib
 import argparse
+from contextlib import contextmanager
 from math import isnan
 
-import requests
 from PIL import Image
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, Response, request, render_template, jsonify
 
 # Path hack to be able to import from sibling directory
 sys.path.append(os.path.abspath(os.path.split(os.path.realpath(__file__))[0]
                                 + '/..'))
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-from src.util import convert_image, crop_image
-from src.search import SearchModel, search
+from src.util import convert_image, crop_image, clip_bounding_box
+from src.admission import AdmissionController, OverloadedError
+from src.fetch import ImageFetcher, FetchCapacityError
+from src.features import compute_features
+from src.prefork import serve_preforked
+from src.search import (SearchModel, search, search_stages, search_by_region,
+                        search_feature_region, search_regions)
+from src.search.cache import FeatureCache
+from src.search.server import SearchClient
+from src.search.session import (SessionStore, session_for_image, 
+                                DEFAULT_SESSION_TTL, DEFAULT_MAX_SESSIONS,
+                                DEFAULT_MAX_SESSION_MB)
+from src.search.warmup import QueryLog, warmup
 
 MAX_FILE_SIZE = 16*1024*1024  # Maximum upload size 16MB
 URL_TIMEOUT = 5  # Maximum time in seconds to wait for connection opening
+MAX_CONCURRENT_DOWNLOADS = 16
 DEFAULT_NUM_RESULTS = 5
+MAX_ROIS = 20  # Maximum number of regions searched in one request
+DEFAULT_PAGE_CACHE_MB = 256
+DEFAULT_LOCALIZE_N = 50
+# Defaults of the admission control config keys
+DEFAULT_MAX_QUEUED_SEARCHES = 16
+DEFAULT_MAX_QUEUE_WAIT = 10
+DEFAULT_DEGRADED_LOCALIZE_N = 0
+DEFAULT_RETRY_AFTER = 1
 
 app = Flask('Historical object retrieval')
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
@@ -35,12 +56,58 @@ parser.add_argument('--test', action='store_true',
                     help='Activate test mode')
 parser.add_argument('--host', default='localhost',
                     help='Host address to listen on')
+parser.add_argument('--port', type=int, default=5000,
+                    help='Port to listen on')
+parser.add_argument('--workers', type=int, default=0,
+                    help='Number of preforked worker processes sharing the '
+                    'search model. By default, serves from a single process')
+parser.add_argument('--threads', type=int, default=4,
+                    help='Number of threads of each worker process')
+parser.add_argument('--query-log', 
+                    help='File to record the results of served queries to')
+parser.add_argument('--warmup', action='store_true',
+                    help='Warm up the search model before serving, '
+                    'preloading the images most often found by the queries '
+                    'in the query log')
+
+# Records served queries if set
+query_log = None
+# Store of paginated search sessions, only available if searching with a 
+# search model of this process
+sessions = None
+# Limits the number of searches running at once if set
+admission = None
+# Number of results localized by searches admitted in degraded mode, where
+# zero disables localization
+degraded_localize_n = DEFAULT_DEGRADED_LOCALIZE_N
+
+# Downloads external images over pooled connections, with at most 
+# MAX_CONCURRENT_DOWNLOADS downloads at once
+fetcher = ImageFetcher(max_concurrent=MAX_CONCURRENT_DOWNLOADS, 
+                       max_size=MAX_FILE_SIZE, timeout=URL_TIMEOUT, 
+                       max_time=5 * URL_TIMEOUT)
+
+# Feature maps of images searched for several regions, keyed by the hash of 
+# the image file, such that the model runs only once per image. Not used with
+# a search server, which computes the feature maps instead.
+page_cache = FeatureCache(None, DEFAULT_PAGE_CACHE_MB * 2**20)
 
 class SearchMode:
-    def __init__(self, localize, rerank, avg_qe):
+    def __init__(self, localize, rerank, avg_qe, 
+                 localize_n=DEFAULT_LOCALIZE_N):
         self.localize = localize
         self.rerank = rerank
         self.avg_qe = avg_qe
+        self.localize_n = localize_n
+
+    def degrade(self, localize_n):
+        """Reduces the work of the search to localizing localize_n results, 
+        or to no localization if localize_n is zero"""
+        if localize_n > 0:
+            self.localize_n = min(self.localize_n, localize_n)
+        else:
+            self.localize = False
+            self.rerank = False
 
 
 class InvalidUsage(Exception):
@@ -59,44 +126,27 @@ class InvalidUsage(Exception):
 def download_file(url):
     """Downloads a file from a URL into a BytesIO object"""
     try:
-        r = requests.get(url, stream=True, timeout=URL_TIMEOUT)
-        r.raise_for_status()
-    except requests.exceptions.RequestException:
-        return None
-
-    if int(r.headers.get('Content-Length')) > MAX_FILE_SIZE:
-        return None
-
-    file = io.BytesIO()
-    size = 0
-    start = time.time()
-    for chunk in r.iter_content(1024):
-        if time.time() - start > 5 * URL_TIMEOUT:
-            return None
-
-        size += len(chunk)
-        if size > MAX_FILE_SIZE:
-            return None
-
-        file.write(chunk)
+        return fetcher.fetch(url)
+    except FetchCapacityError:
+        raise InvalidUsage('Too many concurrent downloads', 503)
 
-    return file
 
-
-def parse_search_parameters(form):
-    if 'x1' not in form or 'y1' not in form \
-        or 'x2' not in form or 'y2' not in form:
+def parse_bounding_box(roi):
+    if 'x1' not in roi or 'y1' not in roi \
+        or 'x2' not in roi or 'y2' not in roi:
         raise InvalidUsage('Missing bounding box parameter', 400)
 
     try:
-        bounding_box = (int(form['x1']), int(form['y1']),
-                        int(form['x2']), int(form['y2']))
-    except ValueError:
+        return (int(roi['x1']), int(roi['y1']), 
+                int(roi['x2']), int(roi['y2']))
+    except (TypeError, ValueError):
         raise InvalidUsage('Invalid bounding box parameter', 400)
 
+
+def parse_search_options(form):
     try:
         num_res = int(form['num_results'])
-    except ValueError:
+    except (KeyError, ValueError):
         num_res = DEFAULT_NUM_RESULTS
     
     if num_res <= 0 or num_res > 100:
@@ -106,32 +156,226 @@ def parse_search_parameters(form):
                              'rerank' in form,
                              'avg_qe' in form)
 
+    return num_res, search_mode
+
+
+def parse_search_parameters(form):
+    bounding_box = parse_bounding_box(form)
+    num_res, search_mode = parse_search_options(form)
     return bounding_box, num_res, search_mode
 
 
-def search_image(image, bounding_box, top_n, search_mode):
+def parse_rois(form):
+    """Parses the JSON encoded list of bounding boxes in the rois field"""
     try:
-        image = Image.open(image).convert('RGB')
+        rois = json.loads(form['rois'])
+    except (KeyError, ValueError):
+        raise InvalidUsage('Missing or invalid rois parameter', 400)
+
+    if not isinstance(rois, list) or len(rois) == 0:
+        raise InvalidUsage('Invalid rois parameter', 400)
+    if len(rois) > MAX_ROIS:
+        raise InvalidUsage('Too many rois, at most {} are '
+                           'allowed'.format(MAX_ROIS), 400)
+    if not all(isinstance(roi, dict) for roi in rois):
+        raise InvalidUsage('Invalid rois parameter', 400)
+
+    return [parse_bounding_box(roi) for roi in rois]
+
+
+def get_image_file():
+    """Returns the uploaded or downloaded image file of a search request"""
+    if 'file' in request.files:  # Image upload
+        return request.files['file']
+    elif 'url' in request.form:  # External image
+        img_file = download_file(request.form['url'])
+        if not img_file:
+            raise InvalidUsage('Error downloading external image', 400)
+        return img_file
+    else:
+        raise InvalidUsage('No image source', 400)
+
+
+def decode_image(image_file):
+    try:
+        return Image.open(image_file).convert('RGB')
     except (IOError, OSError):
         raise InvalidUsage('Error decoding image', 415)
 
+
+def crop_query(image_file, bounding_box):
+    """Decodes an image file and crops it to the searched region"""
+    image = decode_image(image_file)
     try:
-        crop = crop_image(image, bounding_box)
+        return crop_image(image, bounding_box)
     except ValueError as e:
         raise InvalidUsage('Bad bounding box', 400)
 
+
+def check_bounding_box(bounding_box, image_shape):
+    try:
+        clip_bounding_box(bounding_box, image_shape)
+    except ValueError as e:
+        raise InvalidUsage('Bad bounding box', 400)
+
+
+def search_error(e):
+    """Returns the InvalidUsage to raise for an error while searching"""
+    print('Error while searching for roi: {}'.format(e))
+    if app.debug:
+        import traceback
+        traceback.print_tb(e.__traceback__)
+    return InvalidUsage('Internal error while searching', 400)
+
+
+def read_page(image_file):
+    """Reads an image file, only decoding its header
+
+    Returns: (data, image_shape), where data is the content of the file and 
+        image_shape is the shape of the image in the form of (height, width)
+    """
+    data = image_file.read()
+    try:
+        width, height = Image.open(io.BytesIO(data)).size
+    except (IOError, OSError):
+        raise InvalidUsage('Error decoding image', 415)
+    return data, (height, width)
+
+
+def compute_page_features(data):
+    """Computes the feature map of a whole image, reusing the feature map of 
+    a previous request with the same image
+
+    Args:
+    data: content of the image file
+    """
+    def load(key):
+        image = decode_image(io.BytesIO(data))
+        return compute_features(search_model.model, convert_image(image))
+
+    return page_cache.get(hashlib.sha1(data).hexdigest(), load)
+
+
+def admit(search_mode):
+    """Waits until a search may run under admission control, degrading its 
+    search mode if it is admitted in degraded mode
+
+    Args:
+    search_mode: SearchMode of the search, or None if it can not be degraded
+
+    Returns: function to call once the search finished
+
+    Raises: OverloadedError if too many searches are running and waiting 
+        already
+    """
+    if admission is None:
+        return lambda: None
+    if admission.acquire() and search_mode is not None:
+        search_mode.degrade(degraded_localize_n)
+    return admission.release
+
+
+@contextmanager
+def admitted(search_mode):
+    """Runs a search under admission control, see admit"""
+    release = admit(search_mode)
+    try:
+        yield
+    finally:
+        release()
+
+
+def search_image(image, bounding_box, top_n, search_mode):
+    crop = convert_image(crop_query(image, bounding_box))
+
     try:
-        indices, scores, bboxes = search(search_model, convert_image(crop),
-                                         top_n=top_n,
-                                         localize=search_mode.localize,
-                                         rerank=search_mode.rerank,
-                                         avg_qe=search_mode.avg_qe)
+        with admitted(search_mode):
+            indices, scores, bboxes = search(search_model, crop, top_n=top_n,
+                                             localize=search_mode.localize,
+                                             localize_n=search_mode.localize_n,
+                                             rerank=search_mode.rerank,
+                                             avg_qe=search_mode.avg_qe)
     except ValueError as e:
-        print('Error while searching for roi: {}'.format(e))
-        if app.debug:
-            import traceback
-            traceback.print_tb(e.__traceback__)
-        raise InvalidUsage('Internal error while searching', 400)
+        raise search_error(e)
+
+    return build_results(indices, scores, bboxes)
+
+
+def search_image_regions(image, bounding_boxes, top_n, search_mode):
+    """Searches for several regions of one image, which share the feature 
+    map computed on the whole image"""
+    data, image_shape = read_page(image)
+    for bounding_box in bounding_boxes:
+        check_bounding_box(bounding_box, image_shape)
+
+    kwargs = {'top_n': top_n, 'localize': search_mode.localize, 
+              'localize_n': search_mode.localize_n, 
+              'rerank': search_mode.rerank, 'avg_qe': search_mode.avg_qe}
+    image = None
+    if page_cache is None:
+        image = convert_image(decode_image(io.BytesIO(data)))
+
+    try:
+        with admitted(search_mode):
+            if image is not None:
+                region_results = search_regions(search_model, image, 
+                                                bounding_boxes, **kwargs)
+            else:
+                features = compute_page_features(data)
+                region_results = [
+                    search_feature_region(search_model, features, image_shape,
+                                          bounding_box, **kwargs)
+                    for bounding_box in bounding_boxes]
+    except ValueError as e:
+        raise search_error(e)
+
+    return [build_results(*results) for results in region_results]
+
+
+def search_region(feature_idx, bounding_box, top_n, search_mode):
+    if feature_idx < 0 or feature_idx >= len(search_model.feature_metadata):
+        raise InvalidUsage('Invalid image index', 400)
+    metadata = search_model.get_metadata(feature_idx)
+    check_bounding_box(bounding_box, (metadata['height'], metadata['width']))
+
+    try:
+        with admitted(search_mode):
+            indices, scores, bboxes = search_by_region(
+                search_model, feature_idx, bounding_box, top_n=top_n,
+                localize=search_mode.localize, 
+                localize_n=search_mode.localize_n,
+                rerank=search_mode.rerank, avg_qe=search_mode.avg_qe)
+    except ValueError as e:
+        raise search_error(e)
+
+    return build_results(indices, scores, bboxes)
+
+
+def build_result(index, score, bbox):
+    """Returns the response dict of a result image, or None if the image is
+    not found in the database. Score and bbox may be None."""
+    image_path = search_model.get_metadata(index)['image']
+    image_info = search_model.query_database(image_path)
+    if image_info is None:
+        print('Warning: result image {} not found in db'.format(image_path))
+        return None
+    image_dict = {
+        'index': int(index),
+        'name': os.path.basename(image_path),
+        'url': 'static/data/' + image_path,
+        'ext_url': image_info.get('external_url', '')
+    }
+    if score is not None:
+        image_dict['score'] = round(score, 4) if not isnan(score) else 'NaN'
+    if bbox:
+        image_dict['bbox'] = {'x1': bbox[0], 'y1': bbox[1],
+                              'x2': bbox[2], 'y2': bbox[3]}
+    return image_dict
+
+
+def build_results(indices, scores, bboxes):
+    if query_log:
+        query_log.record(indices)
 
     if bboxes is None:
         bboxes = [None for i in range(len(indices))]
@@ -139,24 +383,56 @@ def search_image(image, bounding_box, top_n, search_mode):
     # Build response
     results = []
     for index, score, bbox in zip(indices, scores, bboxes):
-        image_path = search_model.get_metadata(index)['image']
-        image_info = search_model.query_database(image_path)
-        if image_info is None:
-            print('Warning: result image {} not found in db'.format(image_path))
-            continue
-        image_dict = {
-            'name': os.path.basename(image_path),
-            'score': round(score, 4) if not isnan(score) else 'NaN',
-            'url': 'static/data/' + image_path,
-            'ext_url': image_info.get('external_url', '')
-        }
-        if bbox:
-            image_dict['bbox'] = {'x1': bbox[0], 'y1': bbox[1],
-                                  'x2': bbox[2], 'y2': bbox[3]}
-        results.append(image_dict)
+        image_dict = build_result(index, score, bbox)
+        if image_dict is not None:
+            results.append(image_dict)
     return results
 
 
+def stream_results(stages):
+    """Converts the stages of a search to newline delimited JSON objects, 
+    each with the name of the stage under the key stage
+
+    An error while searching ends the stream with an object of the stage 
+    error holding the message of the error. Closing the stream closes the 
+    stages, which stops the search.
+    """
+    try:
+        for stage, results in stages:
+            if stage == 'ranking':
+                indices, scores = results
+                message = {
+                    'stage': stage,
+                    'results': [r for r in (build_result(index, score, None) 
+                                            for index, score in zip(indices, 
+                                                                    scores))
+                                if r is not None]
+                }
+            elif stage == 'localization':
+                index, bbox, score = results
+                result = build_result(index, score, bbox)
+                if result is None:
+                    continue
+                message = {'stage': stage, 'result': result}
+            else:
+                message = {'stage': stage, 'results': build_results(*results)}
+            yield json.dumps(message) + '\n'
+    except Exception as e:
+        message = dict(search_error(e).to_dict(), stage='error')
+        yield json.dumps(message) + '\n'
+    finally:
+        if hasattr(stages, 'close'):
+            stages.close()
+
+
+@app.errorhandler(OverloadedError)
+def handle_overloaded(error):
+    response = jsonify(message='Too many searches, please retry later')
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
 @app.errorhandler(InvalidUsage)
 def handle_invalid_usage(error):
     response = jsonify(error.to_dict())
@@ -198,6 +474,124 @@ def search_url():
     return jsonify(**{'results': results})
 
 
+@app.route("/search_rois", methods=['POST'])
+def search_rois():
+    """Searches for several regions of one uploaded or downloaded image, 
+    given as JSON list of bounding boxes in the rois field"""
+    bounding_boxes = parse_rois(request.form)
+    num_res, search_mode = parse_search_options(request.form)
+
+    img_file = get_image_file()
+    results = search_image_regions(img_file, bounding_boxes, num_res, 
+                                   search_mode)
+    return jsonify(**{'results': results})
+
+
+@app.route("/search_region", methods=['POST'])
+def search_indexed_region():
+    """Searches for a region of an image of the database, given by the 
+    index returned with each result"""
+    search_args = parse_search_parameters(request.form)
+
+    try:
+        feature_idx = int(request.form['index'])
+    except (KeyError, ValueError):
+        raise InvalidUsage('Missing or invalid image index', 400)
+
+    results = search_region(feature_idx, *search_args)
+    return jsonify(**{'results': results})
+
+
+@app.route("/search_stream", methods=['POST'])
+def search_stream():
+    """Searches for an uploaded or downloaded image, streaming the results as
+    newline delimited JSON while they are computed
+    
+    The first object holds the ranking of the first retrieval stage. It is 
+    followed by an object for each result as soon as its localization (and 
+    reranking score) is available, and by an object with the final results, 
+    or an error object if the search fails.
+    """
+    bounding_box, num_res, search_mode = parse_search_parameters(request.form)
+
+    crop = convert_image(crop_query(get_image_file(), bounding_box))
+    release = admit(search_mode)
+    try:
+        stages = search_stages(
+            search_model, crop, top_n=num_res,
+            localize=search_mode.localize, localize_n=search_mode.localize_n,
+            rerank=search_mode.rerank, avg_qe=search_mode.avg_qe)
+    except BaseException as e:
+        release()
+        if isinstance(e, ValueError):
+            raise search_error(e)
+        raise
+
+    response = Response(stream_results(stages), 
+                        mimetype='application/x-ndjson')
+    # The search runs while the response is sent
+    response.call_on_close(release)
+    return response
+
+
+def session_response(session_id, session, page, results):
+    indices, scores, bboxes = results
+    return jsonify(**{
+        'session': session_id,
+        'page': page,
+        'num_pages': session.num_pages,
+        'results': build_results(indices, scores, bboxes)
+    })
+
+
+@app.route("/search_session", methods=['POST'])
+def search_session():
+    """Searches for an uploaded or downloaded image, localizing and 
+    reranking only the results of the first page. Further pages are 
+    requested from /search_session_page with the returned session id."""
+    if sessions is None:
+        raise InvalidUsage('Search sessions are not available', 501)
+    bounding_box, num_res, search_mode = parse_search_parameters(request.form)
+
+    crop = convert_image(crop_query(get_image_file(), bounding_box))
+    try:
+        with admitted(search_mode):
+            session = session_for_image(
+                search_model, crop, page_size=num_res, 
+                localize=search_mode.localize, 
+                localize_n=search_mode.localize_n, 
+                rerank=search_mode.rerank, avg_qe=search_mode.avg_qe)
+            results = session.page(0)
+    except ValueError as e:
+        raise search_error(e)
+
+    return session_response(sessions.add(session), session, 0, results)
+
+
+@app.route("/search_session_page", methods=['POST'])
+def search_session_page():
+    """Returns a page of the results of a search session, given by the 
+    session and page fields. The search mode of a session is fixed when it
+    is created, so pages are never degraded under admission control."""
+    if sessions is None:
+        raise InvalidUsage('Search sessions are not available', 501)
+    try:
+        page = int(request.form['page'])
+    except (KeyError, ValueError):
+        raise InvalidUsage('Missing or invalid page', 400)
+    if page < 0:
+        raise InvalidUsage('Missing or invalid page', 400)
+
+    session_id = request.form.get('session', '')
+    session = sessions.get(session_id)
+    if session is None:
+        raise InvalidUsage('Unknown or expired session', 404)
+
+    with admitted(None):
+        results = session.page(page)
+    return session_response(session_id, session, page, results)
+
+
 if __name__ == "__main__":
     args = parser.parse_args(sys.argv[1:])
 
@@ -206,18 +600,91 @@ if __name__ == "__main__":
 
     if args.test:
         # In test mode, overwrite the default search implementation
-        global search
-        from mock_search import search
+        global search, search_stages, search_by_region, search_feature_region
+        global search_regions, compute_features
+        from mock_search import (search, search_stages, search_by_region, 
+                                 search_feature_region, search_regions, 
+                                 compute_features)
 
     with open(args.config, 'r') as f:
         config = json.load(f)
 
-    search_model = SearchModel(config['model'],
-                               config['features'],
-                               config['database'])
+    if 'server_socket' in config:
+        # Search with the model of a running search server 
+        # (cmd/search_server.py) instead of loading it into this process
+        search_model = SearchClient(config['server_socket'])
+        if not args.test:
+            search = SearchClient.search
+            search_stages = SearchClient.search_stages
+            search_by_region = SearchClient.search_by_region
+            search_regions = SearchClient.search_regions
+        print('Connected to search server on {}'.format(
+            config['server_socket']))
+    else:
+        start_time = time.time()
+        # With preforked workers, the feature store, metadata and PCA are 
+        # loaded memory mapped before forking and thus shared. The model is 
+        # not, as TensorFlow does not support forking after it is 
+        # initialized, so each worker loads its own copy after forking
+        search_model = SearchModel.from_config(config, 
+                                               lazy_model=args.workers > 0)
+        print('Loading the search model took {:.2f} seconds'.format(
+            time.time() - start_time))
+
+    def init_search_model():
+        """Prepares the search model of a serving process"""
+        if not isinstance(search_model, SearchModel):
+            return
+
+        if args.warmup:
+            start_time = time.time()
+            log_path = args.query_log
+            if log_path and not os.path.exists(log_path):
+                log_path = None
+            num_preloaded = warmup(search_model, log_path)
+            print('Warming up took {:.2f} seconds, preloaded {} feature '
+                  'maps'.format(time.time() - start_time, num_preloaded))
+
+    if args.query_log:
+        query_log = QueryLog(args.query_log)
+
+    # Sessions are kept in memory of the process which created them, and are
+    # therefore not available with several worker processes
+    if isinstance(search_model, SearchModel) and not args.test \
+        and args.workers == 0:
+        sessions = SessionStore(config.get('session_ttl', 
+                                           DEFAULT_SESSION_TTL),
+                                config.get('max_sessions', 
+                                           DEFAULT_MAX_SESSIONS),
+                                config.get('max_session_mb', 
+                                           DEFAULT_MAX_SESSION_MB) * 2**20)
+
+    if 'max_running_searches' in config:
+        admission = AdmissionController(
+            config['max_running_searches'],
+            config.get('max_queued_searches', DEFAULT_MAX_QUEUED_SEARCHES),
+            config.get('max_queue_wait', DEFAULT_MAX_QUEUE_WAIT),
+            config.get('degrade_queue_depth'),
+            config.get('retry_after', DEFAULT_RETRY_AFTER))
+        degraded_localize_n = config.get('degraded_localize_n', 
+                                         DEFAULT_DEGRADED_LOCALIZE_N)
+
+    if isinstance(search_model, SearchModel) or args.test:
+        page_cache = FeatureCache(None, config.get('page_cache_mb', 
+                                                   DEFAULT_PAGE_CACHE_MB) 
+                                  * 2**20)
+    else:
+        page_cache = None
     
     print('Server running with model "{}", features "{}" ' 
           'and image database "{}".'.format(config['model'], 
                                             config['features'], 
                                             config['database']))
-    app.run(host=args.host)
+    if args.workers > 0:
+        print('Serving with {} worker processes of {} threads each'.format(
+            args.workers, args.threads))
+        serve_preforked(app, args.host, args.port, args.workers, 
+                        args.threads, init_search_model)
+    else:
+        init_search_model()
+        app.run(host=args.host, port=args.port, threaded=True)
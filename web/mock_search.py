@@ -25,3 +25,49 @@ def search(search_model, query, top_n=0, localize=True, localize_n=50,
         bounding_boxes = None
 
     return indices, similarities, bounding_boxes
+
+
+def search_by_region(search_model, feature_idx, bounding_box, top_n=0, 
+                     localize=True, localize_n=50, rerank=True, avg_qe=True):
+    """A mock region search implementation avoiding the slow computation 
+    time"""
+    return search(search_model, None, top_n, localize, localize_n, rerank, 
+                  avg_qe)
+
+
+def search_feature_region(search_model, features, image_shape, bounding_box,
+                          top_n=0, localize=True, localize_n=50, rerank=True, 
+                          avg_qe=True):
+    """A mock feature map region search implementation avoiding the slow 
+    computation time"""
+    return search(search_model, None, top_n, localize, localize_n, rerank, 
+                  avg_qe)
+
+
+def search_regions(search_model, image, bounding_boxes, top_n=0, localize=True,
+                   localize_n=50, rerank=True, avg_qe=True):
+    """A mock implementation of the search for several regions of an image 
+    avoiding the slow computation time"""
+    return [search(search_model, None, top_n, localize, localize_n, rerank, 
+                   avg_qe)
+            for _ in bounding_boxes]
+
+
+def search_stages(search_model, query, top_n=0, localize=True, localize_n=50, 
+                  rerank=True, avg_qe=True):
+    """A mock implementation of the stages of a search avoiding the slow 
+    computation time"""
+    indices, similarities, bounding_boxes = search(search_model, None, top_n, 
+                                                   localize, localize_n, 
+                                                   rerank, avg_qe)
+    yield 'ranking', (indices, similarities)
+    if localize:
+        for idx, bounding_box in zip(indices, bounding_boxes):
+            yield 'localization', (idx, bounding_box, None)
+    yield 'result', (indices, similarities, bounding_boxes)
+
+
+def compute_features(model, image):
+    """A mock feature computation avoiding the slow computation time"""
+    height, width = max(image.shape[0] // 32, 1), max(image.shape[1] // 32, 1)
+    return np.zeros((height, width, 1), dtype=np.float32)